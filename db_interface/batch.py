@@ -0,0 +1,76 @@
+import sys
+from array import array
+from math import isnan
+import numpy as np
+from db_interface.items import ProductStoreDataItem
+
+STRING_FIELDS = ('code', 'market', 'label', 'product_page_uri', 'product_id', 'store_id', 'store_universal_id')
+NUMBER_FIELDS = ('price', 'discounted_price', 'discount_rate')
+
+
+def _intern(value):
+    return sys.intern(value) if isinstance(value, str) else value
+
+
+class ProductStoreDataBatch():
+    """Compact structure of arrays of the ProductStoreDataItem scraped for a store
+
+    The prices are kept in `array('d')` columns and read as copies in NumPy arrays, so the batch can still grow, a
+    missing price is NaN. The strings are interned, so the markets, store ids and labels repeated in every row are stored once.
+    `DbInterface.insert_temporal_products_data` accepts a batch in place of the list of items and builds the documents
+    from the columns without creating the items, a dict is still built for each row when the batch is written.
+    """
+
+    def __init__(self):
+        self._columns: dict[str, list] = {field: [] for field in STRING_FIELDS}
+        self._numbers: dict[str, array] = {field: array('d') for field in NUMBER_FIELDS}
+        self.scrape_parameters: list[dict] = []
+
+    @classmethod
+    def from_items(cls, items: list[ProductStoreDataItem]) -> "ProductStoreDataBatch":
+        batch = cls()
+        for item in items:
+            batch.append(item)
+        return batch
+
+    def append(self, item: ProductStoreDataItem):
+        for field in STRING_FIELDS:
+            self._columns[field].append(_intern(getattr(item, field)))
+        for field in NUMBER_FIELDS:
+            value = getattr(item, field)
+            self._numbers[field].append(float(value) if value is not None else float('nan'))
+        self.scrape_parameters.append(item.scrape_parameters)
+
+    def __len__(self):
+        return len(self.scrape_parameters)
+
+    @property
+    def price(self) -> np.ndarray:
+        return np.array(self._numbers['price'], dtype=np.float64)
+
+    @property
+    def discounted_price(self) -> np.ndarray:
+        return np.array(self._numbers['discounted_price'], dtype=np.float64)
+
+    @property
+    def discount_rate(self) -> np.ndarray:
+        return np.array(self._numbers['discount_rate'], dtype=np.float64)
+
+    @property
+    def product_ids(self) -> list[str]:
+        return self._columns['product_id']
+
+    @property
+    def market(self) -> str:
+        return self._columns['market'][0] if len(self) else None
+
+    def iter_documents(self):
+        """Yield the rows as dicts with the same fields of `asdict(ProductStoreDataItem)`, the NaN prices are None"""
+        numbers = {field: [None if isnan(x) else x for x in column] for field, column in self._numbers.items()}
+        columns = {**self._columns, **numbers, 'scrape_parameters': self.scrape_parameters}
+        names = list(columns.keys())
+        for values in zip(*columns.values()):
+            yield dict(zip(names, values))
+
+    def to_items(self) -> list[ProductStoreDataItem]:
+        return [ProductStoreDataItem(**document) for document in self.iter_documents()]
@@ -0,0 +1,95 @@
+from typing import Iterator, Iterable
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # pyarrow is an optional dependency, it is only needed by the columnar exports
+    pa = None
+    pq = None
+
+
+def _require_pyarrow():
+    if pa is None:
+        raise ImportError(
+            "pyarrow is needed for the columnar exports, install it with `pip install services_interface[columnar]`")
+
+
+def product_store_data_schema() -> "pa.Schema":
+    """Schema of the exported ProductStoreDataItem documents, `scrape_parameters` is not exported"""
+    _require_pyarrow()
+    return pa.schema([
+        ("product_id", pa.string()),
+        ("store_universal_id", pa.string()),
+        ("store_id", pa.string()),
+        ("code", pa.string()),
+        ("market", pa.string()),
+        ("price", pa.float64()),
+        ("discounted_price", pa.float64()),
+        ("discount_rate", pa.float64()),
+        ("label", pa.string()),
+        ("product_page_uri", pa.string()),
+        ("last_updated", pa.timestamp("ms")),
+    ])
+
+
+def product_schema() -> "pa.Schema":
+    """Schema of the exported ProductItem documents, `informations` and `meta` are not exported"""
+    _require_pyarrow()
+    return pa.schema([
+        ("_id", pa.string()),
+        ("code", pa.string()),
+        ("ean", pa.string()),
+        ("description", pa.string()),
+        ("market", pa.string()),
+        ("brand", pa.string()),
+        ("unit_value", pa.float64()),
+        ("unit_text", pa.string()),
+        ("image_urls", pa.list_(pa.string())),
+        ("categories", pa.list_(pa.string())),
+        ("sales_denomination", pa.string()),
+        ("last_updated", pa.timestamp("ms")),
+    ])
+
+
+def iter_record_batches(docs: Iterable[dict], schema: "pa.Schema", batch_size: int = 10000) -> Iterator["pa.RecordBatch"]:
+    """Decode the documents in record batches of `batch_size` rows, the fields missing in the schema are dropped"""
+    _require_pyarrow()
+    # scraped values are not always of the declared type (e.g. numeric store ids), they are cast while decoding
+    casts = []
+    for field in schema:
+        if pa.types.is_string(field.type):
+            casts.append((field.name, lambda v: v if v is None or isinstance(v, str) else str(v)))
+        elif pa.types.is_floating(field.type):
+            casts.append((field.name, lambda v: v if v is None else float(v)))
+        else:
+            casts.append((field.name, None))
+
+    columns = {name: [] for name in schema.names}
+    rows = 0
+    for doc in docs:
+        for name, cast in casts:
+            value = doc.get(name)
+            columns[name].append(cast(value) if cast is not None else value)
+        rows += 1
+        if rows == batch_size:
+            yield pa.RecordBatch.from_pydict(columns, schema=schema)
+            columns = {name: [] for name in schema.names}
+            rows = 0
+    if rows > 0:
+        yield pa.RecordBatch.from_pydict(columns, schema=schema)
+
+
+def write_parquet(batches: Iterable["pa.RecordBatch"], schema: "pa.Schema", path: str) -> int:
+    """Write the record batches to a Parquet file one at a time and return the number of rows written"""
+    _require_pyarrow()
+    rows = 0
+    with pq.ParquetWriter(path, schema) as writer:
+        for batch in batches:
+            writer.write_batch(batch)
+            rows += batch.num_rows
+    return rows
+
+
+def to_frame(batches: Iterable["pa.RecordBatch"], schema: "pa.Schema"):
+    """Concatenate the record batches in a pandas DataFrame"""
+    _require_pyarrow()
+    return pa.Table.from_batches(batches, schema=schema).to_pandas()
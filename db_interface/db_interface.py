@@ -1,18 +1,33 @@
-from db_interface.items import ProductStoreDataItem, ProductItem, LocationItem, StoreItem
+from db_interface.items import ProductStoreDataItem, ProductItem, LocationItem, StoreItem, compute_product_hash, compute_location_ids, \
+    compute_observation_id, from_dict_to_dataclass
+from db_interface.journal import WriteJournal
+from db_interface.batch import ProductStoreDataBatch
+from db_interface.markets_store import MarketsStore
+from db_interface.postal_index import PostalCodeIndex
+from db_interface.read_settings import ReadSettings, READ_CALL_CLASSES
+from db_interface import columnar
 import pymongo
-from pymongo import UpdateOne
+from pymongo import InsertOne, UpdateOne, ReplaceOne, DeleteOne
 import logging
 from dotenv import load_dotenv
 import os
+import csv
+import time
+import json
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from dataclasses import asdict
 from datetime import datetime, timedelta
 from bson.son import SON
 from math import sqrt, cos, radians
+from typing import Iterator, Union
+import pandas as pd
 
 
 class DbInterface():
 
-    def __init__(self, db_connection=None, db_connection_misc=None, debug=False, is_mock=False):
+    def __init__(self, db_connection=None, db_connection_misc=None, debug=False, is_mock=False, preload_markets=False,
+                 markets_poll_interval=60, preload_postal_index=False, read_settings: dict[str, ReadSettings] = None,
+                 write_retries=3, journal_path=None):
         load_dotenv()
         self.COLLECTION_NAME_POSTAL_CODES = os.getenv(
             "COSMOS_COLLECTION_NAME_POSTAL_CODES")
@@ -24,6 +39,10 @@ class DbInterface():
         self.COLLECTION_NAME_STORES = os.getenv("COSMOS_COLLECTION_NAME_STORES")
         self.COLLECTION_NAME_PRODUCT_STORES_DATA = os.getenv(
             "COSMOS_COLLECTION_NAME_PRODUCT_STORES_DATA")
+        self.COLLECTION_NAME_CHEAPEST_OFFERS = os.getenv(
+            "COSMOS_COLLECTION_NAME_CHEAPEST_OFFERS", "cheapest_offers")
+        self.COLLECTION_NAME_PRODUCT_STORES_DATA_DAILY = os.getenv(
+            "COSMOS_COLLECTION_NAME_PRODUCT_STORES_DATA_DAILY", f"{self.COLLECTION_NAME_PRODUCT_STORES_DATA}_daily")
 
         env_variables = (self.COLLECTION_NAME_POSTAL_CODES, self.COLLECTION_NAME_MARKETS, self.COLLECTION_NAME_PRODUCTS, self.COLLECTION_NAME_LOCATIONS, self.COLLECTION_NAME_STORES, self.COLLECTION_NAME_PRODUCT_STORES_DATA)
         if [x for x in env_variables if x is None]:
@@ -48,9 +67,44 @@ class DbInterface():
         self.debug = debug
         self.is_mock = is_mock
 
+        # <method name or call class>: ReadSettings of the read methods (see `read_settings`)
+        self.read_settings: dict[str, ReadSettings] = read_settings or {}
+
+        # number of times the failed operations of a bulk write are resubmitted (see `_bulk_write`)
+        self.write_retries = write_retries
+        # if enabled, the write batches are spilled to a local file until the db acknowledges them (see `resume_journal`)
+        self.journal: WriteJournal = None
+        if journal_path is not None:
+            self.journal = WriteJournal(journal_path)
+
+        self._postal_codes_indexed = False
+        # until the locations written before `location_id` was stored are backfilled, they are upserted by postal codes
+        self._location_ids_backfilled = False
+        # <product_id>: <content_hash> of the products written by this instance
+        self._product_hashes: dict[str, str] = {}
+        # (<store_universal_id>, <product_id>): <price fields> of the last observation written by this instance
+        self._last_prices: dict[tuple[str, str], tuple] = {}
+
+        # if enabled, the markets are read from memory instead of `misc_db`
+        self.markets_store: MarketsStore = None
+        if preload_markets:
+            self.markets_store = MarketsStore(
+                self.misc_db[self.COLLECTION_NAME_MARKETS], poll_interval=markets_poll_interval, use_change_stream=not is_mock)
+            self.markets_store.start()
+
+        # if enabled, `get_available_markets` finds the stores of a postal code in memory
+        self.postal_index: PostalCodeIndex = None
+        if preload_postal_index:
+            self.postal_index = PostalCodeIndex.build(
+                self.db[self.COLLECTION_NAME_LOCATIONS], self.db[self.COLLECTION_NAME_STORES])
+
     def configure_indexes(self):
         self.db[self.COLLECTION_NAME_LOCATIONS].create_index(
             [("postal_codes", 1)])
+        # the locations are upserted by `location_id`
+        self.backfill_location_ids()
+        self.db[self.COLLECTION_NAME_LOCATIONS].create_index(
+            [("location_id", 1)], unique=True)
 
         self.db[self.COLLECTION_NAME_STORES].create_index(
             [("market", 1), ("last_updated", -1)])
@@ -65,18 +119,169 @@ class DbInterface():
                     "metaField": "_id",
                     "granularity": "minutes"
                 })
-        # self.db[self.COLLECTION_NAME_PRODUCT_STORES_DATA].create_index(
-        #     [("timeseries_meta.product_id", 1), ("timeseries_meta.store_universal_id", 1), ("last_updated", 1)])
+        # Equality fields first, then the range on last_updated (see `index_advisor`)
+        # get_prices, get_most_recent_products, get_store_products_ids, get_products_data_by_store
         self.db[self.COLLECTION_NAME_PRODUCT_STORES_DATA].create_index(
-            [("last_updated", 1), ("timeseries_meta.store_universal_id", 1), ("timeseries_meta.product_id", 1)])
+            [("timeseries_meta.store_universal_id", 1), ("timeseries_meta.product_id", 1), ("last_updated", -1)])
+        # get_product_store_data_to_dump, get_price_history
+        self.db[self.COLLECTION_NAME_PRODUCT_STORES_DATA].create_index(
+            [("timeseries_meta.product_id", 1), ("last_updated", 1)])
+        # get_products_to_scrape
+        self.db[self.COLLECTION_NAME_PRODUCT_STORES_DATA].create_index(
+            [("market", 1), ("last_updated", 1)])
+
+        self.db[self.COLLECTION_NAME_PRODUCTS].create_index([("market", 1)])
+
+        self.db[self.COLLECTION_NAME_PRODUCT_STORES_DATA_DAILY].create_index(
+            [("store_universal_id", 1), ("product_id", 1), ("date", 1)])
+        self.db[self.COLLECTION_NAME_PRODUCT_STORES_DATA_DAILY].create_index(
+            [("date", -1)])
+
+        self.db[self.COLLECTION_NAME_CHEAPEST_OFFERS].create_index(
+            [("postal_codes", 1), ("product_id", 1)])
+        self.db[self.COLLECTION_NAME_CHEAPEST_OFFERS].create_index(
+            [("last_updated", 1)])
 
     def close(self):
         """
         Close connection to the database
         """
+        if self.markets_store is not None:
+            self.markets_store.stop()
         self.db.client.close()
 
+    DUPLICATE_KEY_ERROR = 11000
+    # transient write errors: network, primary step down, interrupted operations, write conflicts and the
+    # "request rate is large" of Cosmos DB
+    RETRYABLE_WRITE_ERRORS = (6, 7, 89, 91, 112, 189, 262, 9001, 10107, 11600, 11602, 13435, 13436, 16500)
+    WRITE_RETRY_BACKOFF = 0.5
+
+    def _bulk_write(self, collection, requests: list, retries: int = None) -> dict[str, int]:
+        """Run an unordered bulk write, resubmitting up to `retries` times only the operations that failed
+
+        The failed operations are the ones listed in the `writeErrors` of the BulkWriteError. A duplicate key error
+        of an insert means the document was written by a previous attempt, so it is not retried. Only the transient
+        errors in `RETRYABLE_WRITE_ERRORS` are retried, any other error, e.g. a document validation failure, is raised
+        at once. If the connection
+        is lost the outcome of the batch is unknown, so the inserts whose `_id` is already stored are dropped (time-series
+        collections don't enforce its uniqueness) and the other operations are all resubmitted.
+        Return the number of `nInserted`, `nUpserted`, `nMatched` and `nModified` documents.
+        """
+        retries = self.write_retries if retries is None else retries
+        counts = {"nInserted": 0, "nUpserted": 0, "nMatched": 0, "nModified": 0}
+        check_stored = False
+        for attempt in range(retries + 1):
+            try:
+                if check_stored:
+                    # the outcome of the previous attempt is unknown
+                    requests, stored = self._drop_stored_inserts(collection, requests)
+                    counts["nInserted"] += stored
+                    check_stored = False
+                    if not requests:
+                        return counts
+                res = collection.bulk_write(requests, ordered=False)
+                for key in counts:
+                    counts[key] += res.bulk_api_result.get(key, 0)
+                return counts
+            except pymongo.errors.BulkWriteError as e:
+                for key in counts:
+                    counts[key] += e.details.get(key, 0)
+                failed = [x for x in e.details["writeErrors"]
+                          if not (x["code"] == self.DUPLICATE_KEY_ERROR and isinstance(requests[x["index"]], InsertOne))]
+                if not failed:
+                    return counts
+                if any(x["code"] not in self.RETRYABLE_WRITE_ERRORS for x in failed):
+                    raise
+                requests = [requests[x["index"]] for x in failed]
+                error = e
+            except pymongo.errors.AutoReconnect as e:
+                error = e
+                check_stored = True
+            if attempt < retries:
+                logging.warning(
+                    f"Bulk write on {collection.name} failed, retrying {len(requests)} operations: {error}")
+                time.sleep(self.WRITE_RETRY_BACKOFF * 2 ** attempt)
+        raise error
+
+    def _drop_stored_inserts(self, collection, requests: list) -> tuple[list, int]:
+        """Drop the inserts whose document `_id` is already stored, return the other requests and the number dropped"""
+        insert_ids = [x._doc["_id"] for x in requests if isinstance(x, InsertOne) and "_id" in x._doc]
+        if not insert_ids:
+            return requests, 0
+        stored_ids = {x["_id"] for x in self._find_ids_chunks(collection, insert_ids, project_mongo={'_id': 1},
+                                                               chunk_size=1000)}
+        requests_left = [x for x in requests
+                         if not (isinstance(x, InsertOne) and x._doc.get("_id") in stored_ids)]
+        return requests_left, len(requests) - len(requests_left)
+
+    def _spill(self, method: str, kwargs: dict) -> str:
+        """Spill a write batch to the journal, if enabled, and return its id"""
+        if self.journal is None:
+            return None
+        return self.journal.append(method, kwargs)
+
+    def _ack(self, batch_id: str):
+        if batch_id is not None:
+            self.journal.ack(batch_id)
+
+    def resume_journal(self) -> int:
+        """Replay the write batches spilled to the journal and never acknowledged, e.g. by a worker that crashed
+
+        The observations of a replayed `insert_temporal_products_data` keep their scrape time and so their `_id`.
+        Time-series collections don't have unique indexes, so the observations written before the crash but not
+        acknowledged are looked up by `_id` and are not written again.
+        Return the number of batches replayed.
+        """
+        if self.journal is None:
+            raise ValueError("The journal is not enabled, set `journal_path`")
+        batches = self.journal.pending()
+        for batch in batches:
+            method, kwargs = batch["method"], batch["kwargs"]
+            if method == "upsert_store_items_batch":
+                kwargs["groups"] = [(from_dict_to_dataclass(LocationItem, location),
+                                     [from_dict_to_dataclass(StoreItem, x) for x in stores])
+                                    for location, stores in kwargs["groups"]]
+            elif method == "upsert_location_items":
+                kwargs["items"] = [from_dict_to_dataclass(LocationItem, x) for x in kwargs["items"]]
+            elif method == "upsert_product_items":
+                kwargs["items"] = [from_dict_to_dataclass(ProductItem, x) for x in kwargs["items"]]
+            elif method == "insert_temporal_products_data":
+                items = [from_dict_to_dataclass(ProductStoreDataItem, x) for x in kwargs["items"]]
+                kwargs["items"] = self._drop_stored_observations(items, kwargs["store_universal_id"], kwargs["last_updated"])
+            else:
+                raise ValueError(f"Can't replay the batch {batch['batch_id']} of the unknown method `{method}`")
+            logging.info(f"Replaying the batch {batch['batch_id']} of {method}")
+            getattr(self, method)(**kwargs)
+            self.journal.ack(batch["batch_id"])
+        self.journal.compact()
+        return len(batches)
+
+    def _drop_stored_observations(self, items: list[ProductStoreDataItem], store_universal_id: str,
+                                  last_updated: datetime) -> list[ProductStoreDataItem]:
+        """Return the items whose observation scraped at `last_updated` is not stored yet"""
+        ids = [compute_observation_id(store_universal_id, x.product_id, last_updated) for x in items]
+        stored_ids = {x["_id"] for x in self._find_ids_chunks(self.db[self.COLLECTION_NAME_PRODUCT_STORES_DATA], ids,
+                                                               project_mongo={'_id': 1}, chunk_size=1000)}
+        return [item for item, _id in zip(items, ids) if _id not in stored_ids]
+
     def upsert_store_items(self, items: list[StoreItem], location_item: LocationItem):
+        market = items[0].market
+        for item in items:
+            if market != item.market:
+                raise ValueError(
+                    "Found two different market values for two different stores. Each store in the list should have the same market value.")
+        self.upsert_store_items_batch([(location_item, items)])
+
+    def upsert_store_items_batch(self, groups: list[tuple[LocationItem, list[StoreItem]]], update_locations: bool = True):
+        """Upsert the stores of many locations and markets with one bulk write for the stores and one for the locations
+
+        Each group is made of a LocationItem and the list of stores scraped for it, the stores can belong to different markets.
+        The locations are identified by the `location_id` of their postal codes (see `compute_location_ids`), in any order.
+        A store found more than once is written once and all its services are added to the field `services`.
+        For each location the field `markets.<market>` is replaced with the ids of the stores of that market in its groups.
+        If `update_locations` is False only the stores are written, e.g. when the stores of a location are written in
+        many batches and the location is written once with all of them by `upsert_location_items`.
+        """
         # Index configuration
         try:
             self.db.validate_collection(self.COLLECTION_NAME_LOCATIONS)
@@ -86,42 +291,190 @@ class DbInterface():
                 f"Collection {self.COLLECTION_NAME_LOCATIONS} or {self.COLLECTION_NAME_STORES} doesn't exist and will be created")
             self.configure_indexes()
 
+        batch_id = None
+        if self.journal is not None:
+            batch_id = self._spill("upsert_store_items_batch", {
+                "groups": [[asdict(location_item), [asdict(x) for x in items]] for location_item, items in groups],
+                "update_locations": update_locations})
+
+        # Merge
+
+        stores = {}
+        stores_services = {}
+        # <store_id>: [<location_ids>], the locations where the store is available (see `update_cheapest_offers`)
+        stores_location_ids = {}
+        # <location_id>: {<market>: [<store_ids>]}
+        locations = {}
+        # <location_id>: <postal_codes>
+        locations_postal_codes = {}
+        location_ids = compute_location_ids([location_item.postal_codes for location_item, _ in groups])
+        for location_id, (location_item, items) in zip(location_ids, groups):
+            locations_postal_codes.setdefault(location_id, sorted(location_item.postal_codes))
+            location_markets = locations.setdefault(location_id, {})
+            for item in items:
+                if item._id not in stores:
+                    stores[item._id] = asdict(item)
+                    stores_services[item._id] = []
+                    stores_location_ids[item._id] = []
+                if item.service not in stores_services[item._id]:
+                    stores_services[item._id].append(item.service)
+                if location_id not in stores_location_ids[item._id]:
+                    stores_location_ids[item._id].append(location_id)
+                market_store_ids = location_markets.setdefault(item.market, [])
+                if item._id not in market_store_ids:
+                    market_store_ids.append(item._id)
+
         # Upload
 
         last_updated = datetime.utcnow()
         bulk_updates = []
-        store_ids = set()
-        market = items[0].market
-        for item in items:
-            item = asdict(item)
-            item_filter = {'_id': item['_id']}
+        for store_id, item in stores.items():
             item["last_updated"] = last_updated
-            if item["_id"] in store_ids:
-                item_set = {"$push": {"services": {"$each": item["services"]}}}
-            else:
-                store_ids.add(item["_id"])
-                item_set = {"$set": item}
-            if market != item["market"]:
-                raise ValueError(
-                    "Found two different market values for two different stores. Each store in the list should have the same market value.")
-            bulk_updates.append(UpdateOne(item_filter, item_set, upsert=True))
-        self.db[self.COLLECTION_NAME_STORES].bulk_write(
-            bulk_updates, ordered=False)
+            item_set = {"$set": item,
+                        "$addToSet": {"services": {"$each": stores_services[store_id]},
+                                      "location_ids": {"$each": stores_location_ids[store_id]}}}
+            bulk_updates.append(UpdateOne({'_id': store_id}, item_set, upsert=True))
+        if bulk_updates:
+            self._bulk_write(self.db[self.COLLECTION_NAME_STORES], bulk_updates)
+        if self.postal_index is not None:
+            self.postal_index.add_stores(stores.values())
 
-        store_ids = list(store_ids)
-        location_filter = {"postal_codes": location_item.postal_codes}
-        location_set = {"$set": {
-            f"markets.{market}": store_ids,
-            "postal_codes": location_item.postal_codes,
-            "last_updated": datetime.utcnow(),
-        }}
-        self.db[self.COLLECTION_NAME_LOCATIONS].update_one(
-            location_filter, location_set, upsert=True)
+        if update_locations:
+            self._upsert_locations(locations, locations_postal_codes, last_updated)
+        self._ack(batch_id)
 
         if self.debug:
             self._print_req_info("UPSERT ITEMS REQ INFO")
 
-    def upsert_product_items(self, items: list[ProductItem]):
+    def upsert_location_items(self, items: list[LocationItem]):
+        """Upsert the locations, for each location the field `markets.<market>` is replaced with the store ids in its `markets`"""
+        batch_id = None
+        if self.journal is not None:
+            batch_id = self._spill("upsert_location_items", {"items": [asdict(x) for x in items]})
+        # <location_id>: {<market>: [<store_ids>]}
+        locations = {}
+        # <location_id>: <postal_codes>
+        locations_postal_codes = {}
+        location_ids = compute_location_ids([x.postal_codes for x in items])
+        for location_id, item in zip(location_ids, items):
+            locations_postal_codes.setdefault(location_id, sorted(item.postal_codes))
+            location_markets = locations.setdefault(location_id, {})
+            for market, store_ids in (item.markets or {}).items():
+                market_store_ids = location_markets.setdefault(market, [])
+                market_store_ids.extend(x for x in store_ids if x not in market_store_ids)
+        self._upsert_locations(locations, locations_postal_codes, datetime.utcnow())
+        self._ack(batch_id)
+
+    def _upsert_locations(self, locations: dict[str, dict[str, list[str]]], locations_postal_codes: dict[str, list[str]],
+                          last_updated: datetime):
+        if not self._location_ids_backfilled:
+            self._location_ids_backfilled = self.db[self.COLLECTION_NAME_LOCATIONS].find_one(
+                {"location_id": {"$exists": False}}, {"_id": 1}) is None
+        bulk_updates = []
+        for location_id, location_markets in locations.items():
+            location_set = {f"markets.{market}": store_ids for market, store_ids in location_markets.items()}
+            location_set["location_id"] = location_id
+            location_set["postal_codes"] = locations_postal_codes[location_id]
+            location_set["last_updated"] = last_updated
+            filter_location = {"location_id": location_id}
+            if not self._location_ids_backfilled:
+                # a location written before `location_id` was stored, with the postal codes sorted
+                filter_location = {"$or": [filter_location, {"postal_codes": locations_postal_codes[location_id]}]}
+            bulk_updates.append(UpdateOne(filter_location, {"$set": location_set}, upsert=True))
+        if bulk_updates:
+            self._bulk_write(self.db[self.COLLECTION_NAME_LOCATIONS], bulk_updates)
+
+        if self.postal_index is not None:
+            for location_id, location_markets in locations.items():
+                for market, store_ids in location_markets.items():
+                    self.postal_index.set_location(locations_postal_codes[location_id], market, store_ids)
+
+    def backfill_location_ids(self, chunk_size: int = 1000) -> int:
+        """Set the `location_id` of the locations written before it was stored, return the number of locations updated
+
+        The documents of the same location, e.g. with the postal codes stored in a different order, are merged
+        (see `_merge_locations`).
+        """
+        collection = self.db[self.COLLECTION_NAME_LOCATIONS]
+        updated = 0
+        locations = []
+        for location in collection.find({'location_id': {'$exists': False}}, self.LOCATION_PROJECTION):
+            locations.append(location)
+            if len(locations) == chunk_size:
+                updated += self._backfill_location_ids_chunk(collection, locations)
+                locations = []
+        if locations:
+            updated += self._backfill_location_ids_chunk(collection, locations)
+        if updated:
+            logging.info(f"Location ids backfilled: {updated}")
+        self._location_ids_backfilled = True
+        return updated
+
+    LOCATION_PROJECTION = {'_id': 1, 'location_id': 1, 'postal_codes': 1, 'markets': 1, 'last_updated': 1}
+
+    def _backfill_location_ids_chunk(self, collection, locations: list[dict]) -> int:
+        # <location_id>: [<locations>], with the locations already stored with that id
+        same_locations = {}
+        for location, location_id in zip(locations, compute_location_ids([x['postal_codes'] for x in locations])):
+            same_locations.setdefault(location_id, []).append(location)
+        for location in collection.find({'location_id': {'$in': list(same_locations.keys())}}, self.LOCATION_PROJECTION):
+            same_locations[location['location_id']].append(location)
+
+        bulk_deletes = []
+        bulk_updates = []
+        for location_id, location_docs in same_locations.items():
+            if len(location_docs) == 1:
+                bulk_updates.append(UpdateOne({'_id': location_docs[0]['_id']}, {'$set': {'location_id': location_id}}))
+            else:
+                location_update, location_deletes = self._merge_locations(location_id, location_docs)
+                bulk_updates.append(location_update)
+                bulk_deletes += location_deletes
+        # the duplicates are deleted first, so the merged location can take their `location_id`
+        if bulk_deletes:
+            self._bulk_write(collection, bulk_deletes)
+        self._bulk_write(collection, bulk_updates)
+        return len(locations)
+
+    @staticmethod
+    def _merge_locations(location_id: str, locations: list[dict]) -> tuple[UpdateOne, list[DeleteOne]]:
+        """Merge the documents of the same location in the most recently updated one and delete the others
+
+        Each market keeps the stores of the most recently updated document that has it.
+        """
+        locations = sorted(locations, key=lambda x: x.get('last_updated') or datetime.min)
+        markets = {}
+        for location in locations:
+            markets.update(location.get('markets') or {})
+        merged = locations[-1]
+        logging.info(f"Merging {len(locations)} documents of the location {location_id}")
+        location_update = UpdateOne({'_id': merged['_id']}, {'$set': {
+            'location_id': location_id, 'postal_codes': sorted(merged['postal_codes']), 'markets': markets}})
+        return location_update, [DeleteOne({'_id': x['_id']}) for x in locations[:-1]]
+
+    @staticmethod
+    def _get_location_id(location: dict) -> str:
+        """Return the `location_id` of a location, computed from its postal codes if it wasn't backfilled yet"""
+        return location.get('location_id') or compute_location_ids([location['postal_codes']])[0]
+
+    @classmethod
+    def _drop_stale_locations(cls, locations) -> list[dict]:
+        """Keep only the most recently updated document of each location, the others are stale duplicates"""
+        latest = {}
+        for location in locations:
+            location_id = cls._get_location_id(location)
+            if location_id not in latest or (location.get('last_updated') or datetime.min) > (
+                    latest[location_id].get('last_updated') or datetime.min):
+                latest[location_id] = location
+        return list(latest.values())
+
+    def upsert_product_items(self, items: list[ProductItem], skip_unchanged: bool = False, use_hash_cache: bool = True) -> dict[str, int]:
+        """Upsert the list of products and return the number of `inserted`, `changed` and `skipped` products
+
+        If `skip_unchanged` is True, a content hash of each product is stored in the field `content_hash`
+        and only new products or products whose hash differs from the stored one are written.
+        The stored hashes are read from the db only for the products missing in the in-process cache,
+        set `use_hash_cache` to False to always read them from the db.
+        """
         try:
             self.db.validate_collection(self.COLLECTION_NAME_PRODUCTS)
         except pymongo.errors.OperationFailure:
@@ -129,23 +482,89 @@ class DbInterface():
                 f"Collection {self.COLLECTION_NAME_PRODUCTS} doesn't exist and will be created")
             self.configure_indexes()
 
+        batch_id = None
+        if self.journal is not None:
+            batch_id = self._spill("upsert_product_items", {
+                "items": [asdict(x) for x in items], "skip_unchanged": skip_unchanged, "use_hash_cache": use_hash_cache})
+        counts = {"inserted": 0, "changed": 0, "skipped": 0}
         bulk_updates = []
         last_updated = datetime.utcnow()
 
+        if skip_unchanged:
+            hashes = {}
+            stored_hashes = self._get_product_hashes(
+                list({item._id for item in items}), use_hash_cache)
+
         for item in items:
             item = asdict(item)
+            if skip_unchanged:
+                content_hash = compute_product_hash(item)
+                hashes[item['_id']] = content_hash
+                if item['_id'] not in stored_hashes:
+                    counts["inserted"] += 1
+                elif stored_hashes[item['_id']] != content_hash:
+                    counts["changed"] += 1
+                else:
+                    counts["skipped"] += 1
+                    continue
+                item["content_hash"] = content_hash
             item_filter = {'_id': item['_id']}
             item["last_updated"] = last_updated
             item_set = {"$set": item}
             bulk_updates.append(UpdateOne(item_filter, item_set, upsert=True))
-        self.db[self.COLLECTION_NAME_PRODUCTS].bulk_write(
-            bulk_updates, ordered=False)
+
+        if bulk_updates:
+            res = self._bulk_write(self.db[self.COLLECTION_NAME_PRODUCTS], bulk_updates)
+            if not skip_unchanged:
+                counts["inserted"] = res["nUpserted"]
+                counts["changed"] = len(bulk_updates) - res["nUpserted"]
+        self._ack(batch_id)
+
+        if skip_unchanged:
+            self._product_hashes.update(hashes)
 
         if self.debug:
             self._print_req_info("UPSERT ITEMS REQ INFO")
 
-    def insert_temporal_products_data(self, items: list[ProductStoreDataItem], store_universal_id: str):
+        return counts
+
+    def _get_product_hashes(self, product_ids: list[str], use_hash_cache: bool = True) -> dict[str, str]:
+        """Return the stored `content_hash` of the existing products, products stored without hash are mapped to None"""
+        stored_hashes = {}
+        ids_to_read = product_ids
+        if use_hash_cache:
+            ids_to_read = []
+            for product_id in product_ids:
+                if product_id in self._product_hashes:
+                    stored_hashes[product_id] = self._product_hashes[product_id]
+                else:
+                    ids_to_read.append(product_id)
+
+        products = self._find_ids_chunks(self.db[self.COLLECTION_NAME_PRODUCTS], ids_to_read,
+                                         project_mongo={'_id': 1, 'content_hash': 1}, chunk_size=1000)
+        for product in products:
+            stored_hashes[product['_id']] = product.get('content_hash')
+        return stored_hashes
+
+    PRICE_FIELDS = ('price', 'discounted_price', 'discount_rate', 'label')
+
+    def insert_temporal_products_data(self, items: Union[list[ProductStoreDataItem], ProductStoreDataBatch], store_universal_id: str, only_changed: bool = False, use_price_cache: bool = True,
+                                      update_cheapest: bool = False, last_updated: datetime = None):
         """Insert the list of scraped product data to the database and also update the value `last_scraped` of the StoreItem identified by `store_universal_id`
+
+        If `only_changed` is True, an item is inserted only if its price fields differ from the last observation of the same
+        (store, product). The ids of the skipped products are saved in the field `unchanged_product_ids` of the StoreItem,
+        so `get_prices` can still return their last observation. The last observations are read from the db only for the
+        products missing in the in-process cache, set `use_price_cache` to False to always read them from the db.
+        If `update_cheapest` is True, the items are also merged in the cheapest offers of the store locations (see `update_cheapest_offers`).
+        `last_updated` is the scrape time, the current time by default. The items of a store scraped in more than one call
+        must all have the same `last_updated`, otherwise `get_prices` only sees the items of the last call. The unchanged
+        products of the calls of the same scrape are accumulated, a newer `last_updated` starts a new list and an older
+        one, e.g. of a replayed batch, leaves `last_scraped` unchanged.
+        Each observation gets a deterministic `_id` from store, product and `last_updated` (see `compute_observation_id`),
+        so a batch sent again with the same `last_updated` is recognizable.
+        `items` can be a `ProductStoreDataBatch`, its documents are built straight from the columns.
+        Return the number of inserted items.
         """
 
         # Index configuration
@@ -162,63 +581,452 @@ class DbInterface():
 
         # Upload
 
-        last_updated = datetime.utcnow()
+        if isinstance(items, ProductStoreDataBatch):
+            iter_documents = items.iter_documents
+            product_ids = items.product_ids
+        else:
+            def iter_documents():
+                return (asdict(item) for item in items)
+            product_ids = [item.product_id for item in items]
+
+        last_updated = last_updated or datetime.utcnow()
+        batch_id = None
+        if self.journal is not None:
+            batch_id = self._spill("insert_temporal_products_data", {
+                "items": list(iter_documents()), "store_universal_id": store_universal_id, "only_changed": only_changed,
+                "use_price_cache": use_price_cache, "update_cheapest": update_cheapest, "last_updated": last_updated})
         items_transformed = []
-        for item in items:
-            item = asdict(item)
+        unchanged_product_ids = []
+        # merged in the price cache only once written
+        new_prices = {}
+        if only_changed:
+            last_prices = self._get_last_prices(
+                store_universal_id, list(set(product_ids)), use_price_cache)
+
+        for item in iter_documents():
+            key = (item["store_universal_id"], item["product_id"])
+            prices = tuple(item[field] for field in self.PRICE_FIELDS)
+            if only_changed:
+                if last_prices.get(item["product_id"]) == prices:
+                    unchanged_product_ids.append(item["product_id"])
+                    continue
+                last_prices[item["product_id"]] = prices
+                new_prices[key] = prices
+            elif key in self._last_prices:
+                new_prices[key] = prices
             item["timeseries_meta"] = {}
             item["timeseries_meta"]["product_id"] = item["product_id"]
             item["timeseries_meta"]["store_universal_id"] = item["store_universal_id"]
             item["last_updated"] = last_updated
-            items_transformed.append(item)
-        self.db[self.COLLECTION_NAME_PRODUCT_STORES_DATA].insert_many(
-            items_transformed, ordered=False
-        )
+            item["_id"] = compute_observation_id(store_universal_id, item["product_id"], last_updated)
+            items_transformed.append(InsertOne(item))
+        if items_transformed:
+            self._bulk_write(self.db[self.COLLECTION_NAME_PRODUCT_STORES_DATA], items_transformed)
+        self._last_prices.update(new_prices)
 
         # Update StoreItem `last_scraped` value
-        self.db[self.COLLECTION_NAME_STORES].update_one(
-            {'_id': store_universal_id}, {'$set': {'last_scraped': last_updated}})
+        collection_stores = self.db[self.COLLECTION_NAME_STORES]
+        if only_changed:
+            # a previous call of the same scrape already set `last_scraped`, its unchanged products are kept
+            res = collection_stores.update_one(
+                {'_id': store_universal_id, 'last_scraped': last_updated},
+                {'$addToSet': {'unchanged_product_ids': {'$each': unchanged_product_ids}}})
+            # `last_scraped` never goes back, e.g. when a batch spilled before a newer scrape is replayed
+            if res.matched_count == 0:
+                collection_stores.update_one(
+                    {'_id': store_universal_id, 'last_scraped': {'$not': {'$gte': last_updated}}},
+                    {'$set': {'last_scraped': last_updated, 'unchanged_product_ids': unchanged_product_ids}})
+        else:
+            collection_stores.update_one(
+                {'_id': store_universal_id, 'last_scraped': {'$not': {'$gte': last_updated}}},
+                {'$set': {'last_scraped': last_updated}, '$unset': {'unchanged_product_ids': ""}})
+
+        if update_cheapest:
+            if isinstance(items, ProductStoreDataBatch):
+                items = items.to_items()
+            self.update_cheapest_offers(items, store_universal_id, last_updated)
+        self._ack(batch_id)
 
         if self.debug:
             self._print_req_info("UPSERT ITEMS REQ INFO")
 
+        return len(items_transformed)
+
+    def _get_last_prices(self, store_universal_id: str, product_ids: list[str], use_price_cache: bool = True) -> dict[str, tuple]:
+        """Return the price fields of the last observation of each product in the store"""
+        last_prices = {}
+        ids_to_read = product_ids
+        if use_price_cache:
+            ids_to_read = []
+            for product_id in product_ids:
+                key = (store_universal_id, product_id)
+                if key in self._last_prices:
+                    last_prices[product_id] = self._last_prices[key]
+                else:
+                    ids_to_read.append(product_id)
+
+        for product_id, product_data in self._get_last_products_data(store_universal_id, ids_to_read).items():
+            prices = tuple(product_data.get(field) for field in self.PRICE_FIELDS)
+            last_prices[product_id] = prices
+            self._last_prices[(store_universal_id, product_id)] = prices
+        return last_prices
+
+    def _get_last_products_data(self, store_universal_id: str, product_ids: list[str], before: datetime = None,
+                                chunk_size: int = 1000, call: str = None) -> dict[str, dict]:
+        """Return the last observation of each product in the store, optionally only the ones older than `before`
+
+        The products whose raw observations expired (see `configure_retention`) get the close values of their last
+        rolled up day. `call` is the read method whose read settings are applied, if any
+        """
+        collection = self._get_collection(self.COLLECTION_NAME_PRODUCT_STORES_DATA, call=call)
+        command_options = self._get_command_options(call) if call is not None else {}
+        products_data = {}
+        for i in range(0, len(product_ids), chunk_size):
+            match = {"timeseries_meta.store_universal_id": store_universal_id,
+                     "timeseries_meta.product_id": {"$in": product_ids[i:i + chunk_size]}}
+            if before is not None:
+                match["last_updated"] = {"$lt": before}
+            pipeline = [
+                {"$match": match},
+                {"$sort": SON([("last_updated", -1)])},
+                {"$group": {"_id": "$timeseries_meta.product_id",
+                            "price": {"$first": "$price"},
+                            "discounted_price": {"$first": "$discounted_price"},
+                            "discount_rate": {"$first": "$discount_rate"},
+                            "label": {"$first": "$label"},
+                            "product_page_uri": {"$first": "$product_page_uri"}}},
+            ]
+            for product_data in collection.aggregate(pipeline, **command_options):
+                products_data[product_data.pop("_id")] = product_data
+            missing_ids = [x for x in product_ids[i:i + chunk_size] if x not in products_data]
+            if missing_ids:
+                products_data.update(self._get_last_daily_products_data(store_universal_id, missing_ids, before, call))
+        return products_data
+
+    def _get_last_daily_products_data(self, store_universal_id: str, product_ids: list[str], before: datetime = None,
+                                      call: str = None) -> dict[str, dict]:
+        """See `_get_last_products_data`, the observation is read from the close values of the daily collection"""
+        collection = self._get_collection(self.COLLECTION_NAME_PRODUCT_STORES_DATA_DAILY, call=call)
+        match = {"store_universal_id": store_universal_id, "product_id": {"$in": product_ids}}
+        if before is not None:
+            match["date"] = {"$lt": before}
+        pipeline = [
+            {"$match": match},
+            {"$sort": SON([("date", -1)])},
+            {"$group": {"_id": "$product_id",
+                        **{field: {"$first": f"$close_{field}"} for field in self.OFFER_FIELDS}}},
+        ]
+        command_options = self._get_command_options(call) if call is not None else {}
+        return {product_data.pop("_id"): product_data
+                for product_data in collection.aggregate(pipeline, **command_options)}
+
+    CHEAPEST_OFFERS_TOP_N = 5
+    OFFER_FIELDS = ('price', 'discounted_price', 'discount_rate', 'label', 'product_page_uri')
+
+    @staticmethod
+    def _sort_offers(offers: list[dict], top_n: int) -> list[dict]:
+        """Sort the offers from the cheapest and keep the first `top_n`"""
+        offers.sort(key=lambda x: x['discounted_price'] if x.get('discounted_price') is not None else x['price'])
+        return offers[:top_n]
+
+    def _get_stores_current_offers(self, store_ids: list[str]) -> dict[str, dict[str, dict]]:
+        """Return {<store_universal_id>: {<product_id>: <offer>}} with the prices of the last scrape of each store"""
+        stores = self._find_ids_chunks(self.db[self.COLLECTION_NAME_STORES], store_ids,
+                                       project_mongo={'_id': 1, 'market': 1, 'last_scraped': 1, 'unchanged_product_ids': 1},
+                                       chunk_size=1000)
+        projection = {'_id': 0, 'product_id': 1, 'last_updated': 1, **{field: 1 for field in self.OFFER_FIELDS}}
+        stores_offers = {}
+        for store in stores:
+            offers = {}
+            stores_offers[store['_id']] = offers
+            if store.get('last_scraped') is None:
+                continue
+            products_data = self.db[self.COLLECTION_NAME_PRODUCT_STORES_DATA].find({
+                'timeseries_meta.store_universal_id': store['_id'],
+                'last_updated': {'$gte': store['last_scraped']}
+            }, projection)
+            for product_data in products_data:
+                product_data['last_updated'] = store['last_scraped']
+                offers[product_data.pop('product_id')] = product_data
+            unchanged_product_ids = [x for x in store.get('unchanged_product_ids', []) if x not in offers]
+            for product_id, product_data in self._get_last_products_data(
+                    store['_id'], unchanged_product_ids, before=store['last_scraped']).items():
+                product_data['last_updated'] = store['last_scraped']
+                offers[product_id] = product_data
+            for offer in offers.values():
+                offer['store_universal_id'] = store['_id']
+                offer['market'] = store['market']
+        return stores_offers
+
+    @staticmethod
+    def _get_location_store_ids(location: dict) -> list[str]:
+        return [store_id for market_store_ids in (location.get('markets') or {}).values()
+                for store_id in market_store_ids]
+
+    def rebuild_cheapest_offers(self, top_n: int = None, chunk_size: int = 1000, locations_chunk_size: int = 100) -> int:
+        """Recompute the cheapest offers of every product for every location
+
+        For each location and product a document identified by `<location_id>_<product_id>` is written with the
+        `top_n` cheapest offers of the stores of the location, the cheapest first. The documents not refreshed
+        by this run are deleted. Return the number of documents written.
+        The locations are processed sorted by postal code in chunks of `locations_chunk_size`, the current offers of
+        the stores of a chunk are read at once and released as soon as no remaining location needs them.
+        """
+        top_n = top_n or self.CHEAPEST_OFFERS_TOP_N
+        started = datetime.utcnow()
+        written = 0
+        bulk_updates = []
+        locations = self._drop_stale_locations(self.db[self.COLLECTION_NAME_LOCATIONS].find(
+            {}, {'_id': 0, 'location_id': 1, 'postal_codes': 1, 'markets': 1, 'last_updated': 1}).sort('postal_codes', 1))
+        # <store_universal_id>: number of the locations still to process where the store is available
+        remaining_locations = {}
+        for location in locations:
+            for store_id in self._get_location_store_ids(location):
+                remaining_locations[store_id] = remaining_locations.get(store_id, 0) + 1
+
+        stores_offers = {}
+        for i in range(0, len(locations), locations_chunk_size):
+            locations_chunk = locations[i:i + locations_chunk_size]
+            missing_store_ids = list({store_id for location in locations_chunk
+                                      for store_id in self._get_location_store_ids(location)
+                                      if store_id not in stores_offers})
+            if missing_store_ids:
+                stores_offers.update(self._get_stores_current_offers(missing_store_ids))
+
+            for location in locations_chunk:
+                location_id = self._get_location_id(location)
+                store_ids = self._get_location_store_ids(location)
+                products_offers = {}
+                for store_id in store_ids:
+                    for product_id, offer in stores_offers.get(store_id, {}).items():
+                        products_offers.setdefault(product_id, []).append(offer)
+
+                last_updated = datetime.utcnow()
+                for product_id, offers in products_offers.items():
+                    bulk_updates.append(ReplaceOne({'_id': f"{location_id}_{product_id}"}, {
+                        'location_id': location_id,
+                        'postal_codes': location['postal_codes'],
+                        'product_id': product_id,
+                        'offers': self._sort_offers(offers, top_n),
+                        'last_updated': last_updated,
+                    }, upsert=True))
+                    if len(bulk_updates) >= chunk_size:
+                        self._bulk_write(self.db[self.COLLECTION_NAME_CHEAPEST_OFFERS], bulk_updates)
+                        written += len(bulk_updates)
+                        bulk_updates = []
+
+                for store_id in store_ids:
+                    remaining_locations[store_id] -= 1
+                    if remaining_locations[store_id] == 0:
+                        stores_offers.pop(store_id, None)
+        if bulk_updates:
+            self._bulk_write(self.db[self.COLLECTION_NAME_CHEAPEST_OFFERS], bulk_updates)
+            written += len(bulk_updates)
+
+        self.db[self.COLLECTION_NAME_CHEAPEST_OFFERS].delete_many({'last_updated': {'$lt': started}})
+        logging.info(f"Cheapest offers rebuilt: {written}")
+        return written
+
+    def update_cheapest_offers(self, items: list[ProductStoreDataItem], store_universal_id: str, last_updated: datetime = None,
+                               top_n: int = None):
+        """Merge the scraped prices of a store in the cheapest offers of every location where the store is available
+
+        The locations of the store are read from its `location_ids`, the stores written before that field existed
+        fall back to a scan of the locations. The previous offer of the store is replaced. If the store gets more expensive, a store that was not
+        in the top `top_n` can't take its place until the next `rebuild_cheapest_offers`.
+        The offers keep the scrape time `last_updated`, the documents are stamped with the write time so that a
+        concurrent `rebuild_cheapest_offers` doesn't delete them as stale.
+        """
+        if len(items) == 0:
+            return
+        top_n = top_n or self.CHEAPEST_OFFERS_TOP_N
+        last_updated = last_updated or datetime.utcnow()
+        market = items[0].market
+        new_offers = {}
+        for item in items:
+            offer = {field: getattr(item, field) for field in self.OFFER_FIELDS}
+            offer['last_updated'] = last_updated
+            offer['store_universal_id'] = store_universal_id
+            offer['market'] = market
+            new_offers[item.product_id] = offer
+
+        collection = self.db[self.COLLECTION_NAME_CHEAPEST_OFFERS]
+        # the locations are found by the indexed `location_id` from the `location_ids` of the store
+        filter_locations = {f"markets.{market}": store_universal_id}
+        store = self.db[self.COLLECTION_NAME_STORES].find_one({'_id': store_universal_id}, {'location_ids': 1})
+        if store is not None and 'location_ids' in store:
+            filter_locations['location_id'] = {'$in': store['location_ids']}
+        locations = self.db[self.COLLECTION_NAME_LOCATIONS].find(
+            filter_locations, {'_id': 0, 'location_id': 1, 'postal_codes': 1})
+        for location in locations:
+            location_id = self._get_location_id(location)
+            current = self._find_ids_chunks(collection, [f"{location_id}_{x}" for x in new_offers],
+                                            project_mongo={'product_id': 1, 'offers': 1}, chunk_size=1000)
+            current_offers = {x['product_id']: x['offers'] for x in current}
+
+            bulk_updates = []
+            for product_id, offer in new_offers.items():
+                offers = [x for x in current_offers.get(product_id, []) if x['store_universal_id'] != store_universal_id]
+                offers.append(offer)
+                bulk_updates.append(UpdateOne({'_id': f"{location_id}_{product_id}"}, {'$set': {
+                    'location_id': location_id,
+                    'postal_codes': location['postal_codes'],
+                    'product_id': product_id,
+                    'offers': self._sort_offers(offers, top_n),
+                    'last_updated': datetime.utcnow(),
+                }}, upsert=True))
+            self._bulk_write(collection, bulk_updates)
+
+    def get_cheapest_offers(self, postal_code: str, product_ids: list[str] = None, top_n: int = None) -> dict[str, list[dict]]:
+        """Return {<product_id>: <offers>} with the cheapest offers, the cheapest first, of the stores available for the postal code"""
+        top_n = top_n or self.CHEAPEST_OFFERS_TOP_N
+        filter_offers = {'postal_codes': postal_code}
+        if product_ids is not None:
+            filter_offers['product_id'] = {'$in': product_ids}
+        products_offers = {}
+        cursor_offers = self._get_collection(self.COLLECTION_NAME_CHEAPEST_OFFERS, call='get_cheapest_offers').find(
+            filter_offers, {'_id': 0, 'product_id': 1, 'offers': 1},
+            max_time_ms=self._get_max_time_ms('get_cheapest_offers'))
+        for doc in cursor_offers:
+            if doc['product_id'] in products_offers:
+                # the postal code belongs to more than one location
+                store_ids = {x['store_universal_id'] for x in products_offers[doc['product_id']]}
+                offers = products_offers[doc['product_id']] + [x for x in doc['offers'] if x['store_universal_id'] not in store_ids]
+                products_offers[doc['product_id']] = self._sort_offers(offers, top_n)
+            else:
+                products_offers[doc['product_id']] = doc['offers'][:top_n]
+        return products_offers
+
+    def _configure_postal_codes_indexes(self, collection):
+        collection.create_index([("postal_code", 1)])
+
     def insert_cap(self, items: list[dict]):
-        # Index configuration
-        self.misc_db[self.COLLECTION_NAME_POSTAL_CODES].create_index(
-            [("postal_code", 1)])
+        # Index configuration, only once per instance
+        if not self._postal_codes_indexed:
+            self._configure_postal_codes_indexes(
+                self.misc_db[self.COLLECTION_NAME_POSTAL_CODES])
+            self._postal_codes_indexed = True
 
         # Upload
         res = self.misc_db[self.COLLECTION_NAME_POSTAL_CODES].insert_many(
             items, ordered=False, )
         logging.info(res)
 
+    @staticmethod
+    def _iter_postal_codes_file(path: str, file_format: str = None):
+        """Stream the rows of a CSV (with header) or NDJSON file of postal codes as dicts"""
+        if file_format is None:
+            file_format = 'csv' if path.lower().endswith('.csv') else 'ndjson'
+        if file_format not in ('csv', 'ndjson'):
+            raise ValueError(f"File format `{file_format}` is not supported, it must be `csv` or `ndjson`")
+
+        with open(path, encoding='utf-8', newline='') as f_in:
+            if file_format == 'csv':
+                rows = csv.DictReader(f_in)
+            else:
+                rows = (json.loads(line) for line in f_in if line.strip())
+            for row in rows:
+                if row.get('postal_code') is None:
+                    raise ValueError(f"Found a row without `postal_code` in {path}: {row}")
+                row['postal_code'] = str(row['postal_code'])
+                yield row
+
+    def load_postal_codes(self, path: str, file_format: str = None, batch_size: int = 1000, workers: int = 4) -> int:
+        """Load a CSV or NDJSON file of postal codes, replacing the whole postal codes collection
+
+        The rows are streamed from the file and inserted in batches of `batch_size` by `workers` parallel threads
+        in a staging collection. The indexes are built once after the load, then the staging collection is renamed
+        to the postal codes collection, so a failed or repeated load never leaves the collection half loaded.
+        Return the number of postal codes loaded.
+        """
+        staging = self.misc_db[f"{self.COLLECTION_NAME_POSTAL_CODES}_staging"]
+        staging.drop()
+
+        def _insert(batch: list[dict]) -> int:
+            staging.insert_many(batch, ordered=False)
+            return len(batch)
+
+        loaded = 0
+        pending = set()
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            batch = []
+            for row in self._iter_postal_codes_file(path, file_format):
+                batch.append(row)
+                if len(batch) == batch_size:
+                    pending.add(executor.submit(_insert, batch))
+                    batch = []
+                # backpressure: don't read the file faster than the db can write it
+                if len(pending) >= workers * 2:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    loaded += sum(f.result() for f in done)
+            if batch:
+                pending.add(executor.submit(_insert, batch))
+            loaded += sum(f.result() for f in pending)
+
+        self._configure_postal_codes_indexes(staging)
+        staging.rename(self.COLLECTION_NAME_POSTAL_CODES, dropTarget=True)
+        self._postal_codes_indexed = True
+        logging.info(f"Postal codes loaded: {loaded}")
+        return loaded
+
     def _find_ids_chunks(self, collection, ids: list, id_field: str = '_id', project_mongo: dict = {},
-                         chunk_size: int = 100):
+                         chunk_size: int = 100, max_time_ms: int = None):
         res = []
         for i in range(0, len(ids), chunk_size):
             ids_chunk = list(ids[i:i + chunk_size])
             res_chunk = list(collection.find(
                 {id_field: {'$in': ids_chunk}},
-                project_mongo
+                project_mongo,
+                max_time_ms=max_time_ms
             ))
             res.extend(res_chunk)
         return res
 
     def get_market_products(self, market: str):
-        it_products = self.db[self.COLLECTION_NAME_PRODUCTS].find({
+        it_products = self._get_collection(self.COLLECTION_NAME_PRODUCTS, call='get_market_products').find({
             "market": market
-        })
+        }, max_time_ms=self._get_max_time_ms('get_market_products'))
         return list(it_products)
 
     def get_store_products_ids(self, store_id: str):
-        products_ids = self.db[self.COLLECTION_NAME_PRODUCT_STORES_DATA].distinct(
-            'timeseries_meta.product_id', {'timeseries_meta.store_universal_id': store_id})
+        products_ids = self._get_collection(self.COLLECTION_NAME_PRODUCT_STORES_DATA, call='get_store_products_ids').distinct(
+            'timeseries_meta.product_id', {'timeseries_meta.store_universal_id': store_id},
+            **self._get_command_options('get_store_products_ids'))
         return list(products_ids)
 
+    def _get_read_settings(self, call: str) -> ReadSettings:
+        """Return the settings of the read method `call`, else the ones of its call class, else the defaults"""
+        if call in self.read_settings:
+            return self.read_settings[call]
+        return self.read_settings.get(READ_CALL_CLASSES.get(call), ReadSettings())
+
+    def _get_collection(self, collection_name: str, call: str = None, db=None):
+        """Return the collection, if `call` is given the read preference and read concern of the read method `call` are applied"""
+        collection = (db if db is not None else self.db)[collection_name]
+        options = {}
+        if call is not None:
+            read_settings = self._get_read_settings(call)
+            if read_settings.read_preference is not None:
+                options['read_preference'] = read_settings.read_preference
+            if read_settings.read_concern is not None:
+                options['read_concern'] = read_settings.read_concern
+        if options:
+            return collection.with_options(**options)
+        return collection
+
+    def _get_max_time_ms(self, call: str) -> int:
+        """Return the `max_time_ms` of the `find` cursors of the read method `call`"""
+        return self._get_read_settings(call).max_time_ms
+
+    def _get_command_options(self, call: str) -> dict:
+        """Return the `maxTimeMS` option of the `aggregate` and `distinct` commands of the read method `call`"""
+        max_time_ms = self._get_max_time_ms(call)
+        return {'maxTimeMS': max_time_ms} if max_time_ms is not None else {}
+
     def get_market_stores(self, market: str):
-        it_stores = self.db[self.COLLECTION_NAME_STORES].find({
+        it_stores = self._get_collection(self.COLLECTION_NAME_STORES, call='get_market_stores').find({
             "market": market
-        })
+        }, max_time_ms=self._get_max_time_ms('get_market_stores'))
         return list(it_stores)
 
     def get_most_recent_products(self, store_id: str, product_ids: list[str]):
@@ -228,31 +1036,39 @@ class DbInterface():
             {"$sort": SON([("last_updated", -1)])},
             {"$group": {"_id": "$timeseries_meta.product_id",
                         "last_updated": {"$first": "$last_updated"}}},
-            {"$project": SON(
-                {("_id", 0), ("timeseries_meta.product_id", 0), ("last_updated", 1)})}
+            {"$project": SON([("_id", 0), ("last_updated", 1)])}
         ]
-        most_recent_date = list(
-            self.db[self.COLLECTION_NAME_PRODUCT_STORES_DATA].aggregate(pipeline))
+        collection = self._get_collection(self.COLLECTION_NAME_PRODUCT_STORES_DATA, call='get_most_recent_products')
+        most_recent_date = list(collection.aggregate(
+            pipeline, **self._get_command_options('get_most_recent_products')))
 
         if len(most_recent_date) == 0:
             logging.warning(
                 f'No products_data_found for store {store_id} for ids {product_ids}')
             return []
-        it_products_data = self.db[self.COLLECTION_NAME_PRODUCT_STORES_DATA].find({
+        it_products_data = collection.find({
             "timeseries_meta.store_universal_id": store_id,
             "timeseries_meta.product_id": {"$in": product_ids},
             "last_updated": {"$gte": most_recent_date[0]['last_updated']}
-        })
+        }, max_time_ms=self._get_max_time_ms('get_most_recent_products'))
         return list(it_products_data)
 
     def get_markets(self, filter_mongo: dict = {}, project_mongo: dict = {}):
-        cursor_markets = self.misc_db[self.COLLECTION_NAME_MARKETS]
-        return list(cursor_markets.find(filter_mongo, project_mongo))
+        cursor_markets = self._get_collection(self.COLLECTION_NAME_MARKETS, call='get_markets', db=self.misc_db)
+        return list(cursor_markets.find(filter_mongo, project_mongo, max_time_ms=self._get_max_time_ms('get_markets')))
 
     def get_available_markets(self, postal_code: str, lat: float, lon: float):
         """Fetch all markets that are available for the input postal_code
         Each market is characterized by the list of stores and some other meta information
+
+        If the postal code index is enabled, the stores are read from memory and their `geo_point` has only `lat` and `long`
         """
+        if self.postal_index is not None:
+            markets = {market: {'stores': stores, 'meta': {}}
+                       for market, stores in self.postal_index.lookup(postal_code, lat, lon).items()}
+            for market_info in self._get_markets_info(list(markets.keys())):
+                markets[market_info['name_lower']]['meta'] = market_info
+            return markets
 
         def _compute_distance_fast(lat1, lon1, lat2, lon2):
             R = 6371  # radius of the earth in km
@@ -263,14 +1079,15 @@ class DbInterface():
             return round(d, 2)
 
         filter_locations = {'postal_codes': postal_code}
-        cursor_locations = self.db[self.COLLECTION_NAME_LOCATIONS].find(
-            filter_locations, {'_id': -1, 'markets': 1})
+        cursor_locations = self._get_collection(self.COLLECTION_NAME_LOCATIONS, call='get_available_markets').find(
+            filter_locations, {'_id': 0, 'location_id': 1, 'postal_codes': 1, 'markets': 1, 'last_updated': 1},
+            max_time_ms=self._get_max_time_ms('get_available_markets'))
 
         markets = {}
         market_names = set()
 
         store_ids = set()
-        for location in cursor_locations:
+        for location in self._drop_stale_locations(cursor_locations):
             for market, market_store_ids in location['markets'].items():
                 store_ids.update(market_store_ids)
                 markets[market] = {
@@ -285,10 +1102,12 @@ class DbInterface():
             'geo_point': 1,
             'service': 1
         }
+
         chunk_size = 1000
         store_ids = list(store_ids)
-        stores = self._find_ids_chunks(self.db[self.COLLECTION_NAME_STORES], store_ids, project_mongo=projection_stores,
-                                       chunk_size=chunk_size)
+        stores = self._find_ids_chunks(self._get_collection(self.COLLECTION_NAME_STORES, call='get_available_markets'),
+                                       store_ids, project_mongo=projection_stores, chunk_size=chunk_size,
+                                       max_time_ms=self._get_max_time_ms('get_available_markets'))
         for store in stores:
             market_name = store['market']
             market_names.add(market_name)
@@ -302,58 +1121,82 @@ class DbInterface():
                 store['distance'] = 9999
             markets[market_name]['stores'].append(store)
 
-        market_names = list(market_names)
-        markets_info = self.get_markets(
-            {'name_lower': {'$in': market_names}}, {'_id': 0})
+        markets_info = self._get_markets_info(list(market_names))
         for market_info in markets_info:
             market_name = market_info['name_lower']
             markets[market_name]['meta'] = market_info
+        # also the markets without meta information, like the postal code index path
+        for market_name in market_names:
             markets[market_name]['stores'].sort(key=lambda x: x['distance'])
 
         return markets
 
+    def _get_markets_info(self, market_names: list[str]) -> list[dict]:
+        if self.markets_store is not None:
+            return self.markets_store.get(market_names)
+        return self.get_markets({'name_lower': {'$in': market_names}}, {'_id': 0})
+
     def get_prices(self, product_ids: list[str], store_id: str):
-        store = self.db[self.COLLECTION_NAME_STORES].find_one(
-            {'_id': store_id}, {'_id': 1, 'last_scraped': 1})
-        if store is None:
+        """Return the prices of the last scrape of the store
+
+        Products skipped by a change-only scrape (see `insert_temporal_products_data`) get their last observation
+        """
+        stores = list(self._get_collection(self.COLLECTION_NAME_STORES, call='get_prices').aggregate([
+            {'$match': {'_id': store_id}},
+            {'$project': {'_id': 1, 'last_scraped': 1, 'unchanged_product_ids': {'$filter': {
+                'input': {'$ifNull': ['$unchanged_product_ids', []]},
+                'cond': {'$in': ['$$this', product_ids]}}}}}
+        ], **self._get_command_options('get_prices')))
+        if len(stores) == 0:
             raise KeyError(f'Store {store_id} not found in the db')
+        store = stores[0]
 
         filter_products_data = {
             'timeseries_meta.product_id': {'$in': product_ids},
             'timeseries_meta.store_universal_id': store['_id'],
             'last_updated': {'$gte': store['last_scraped']}
         }
-        products_data = self.db[self.COLLECTION_NAME_PRODUCT_STORES_DATA].find(filter_products_data,
-                                                                               {
-                                                                                   '_id': 0,
-                                                                                   'product_id': 1,
-                                                                                   'price': 1,
-                                                                                   'discounted_price': 1,
-                                                                                   'discount_rate': 1,
-                                                                                   'label': 1,
-                                                                                   'product_page_uri': 1
-                                                                               })
+
+        collection = self._get_collection(self.COLLECTION_NAME_PRODUCT_STORES_DATA, call='get_prices')
+        products_data = collection.find(filter_products_data,
+                                        {
+                                            '_id': 0,
+                                            'product_id': 1,
+                                            'price': 1,
+                                            'discounted_price': 1,
+                                            'discount_rate': 1,
+                                            'label': 1,
+                                            'product_page_uri': 1
+                                        },
+                                        max_time_ms=self._get_max_time_ms('get_prices'))
 
         prices_data = {}
         for p in products_data:
             product_id = p.pop('product_id')
             prices_data[product_id] = p
 
+        unchanged_product_ids = [
+            x for x in store['unchanged_product_ids'] if x not in prices_data]
+        if unchanged_product_ids:
+            prices_data.update(self._get_last_products_data(
+                store['_id'], unchanged_product_ids, before=store['last_scraped'], call='get_prices'))
+
         return prices_data
 
     def get_geo_points(self, filter: dict = {}):
-        cursor_geo_points = self.misc_db[self.COLLECTION_NAME_GEO_POINTS]
-        return list(cursor_geo_points.find(filter))
+        cursor_geo_points = self._get_collection(self.COLLECTION_NAME_POSTAL_CODES, call='get_geo_points', db=self.misc_db)
+        return list(cursor_geo_points.find(filter, max_time_ms=self._get_max_time_ms('get_geo_points')))
 
     def get_stores(self, filter: dict = {}):
-        cursor_stores = self.db[self.COLLECTION_NAME_STORES]
-        return list(cursor_stores.find(filter))
+        cursor_stores = self._get_collection(self.COLLECTION_NAME_STORES, call='get_stores')
+        return list(cursor_stores.find(filter, max_time_ms=self._get_max_time_ms('get_stores')))
 
     def get_products_data_by_store(self, universal_store_id: str) -> list[dict]:
         """Given the unique id of a store, it returns the list of products data scraped for it
         Each item returned is defined by the fields _id, last_updated and scrape_parameters
         """
-        cursor_product_store_data = self.db[self.COLLECTION_NAME_PRODUCT_STORES_DATA]
+        cursor_product_store_data = self._get_collection(
+            self.COLLECTION_NAME_PRODUCT_STORES_DATA, call='get_products_data_by_store')
         # distinct_products = cursor_product_store_data.find({'timeseries_meta.store_universal_id': universal_store_id}).distinct('timeseries_meta.product_id')
         distinct_products = cursor_product_store_data.aggregate([
             {"$match": {"timeseries_meta.store_universal_id": universal_store_id}},
@@ -363,13 +1206,18 @@ class DbInterface():
                 "last_updated": {"$max": "$last_updated"},
                 "scrape_parameters": {"$first": "$scrape_parameters"}}
              },
-        ])
+        ], **self._get_command_options('get_products_data_by_store'))
         return list(distinct_products)
 
     def get_products_to_scrape(self, market: str, date_hard: datetime):
         """Return every fast-scraped product since `date_hard` that has not been hard-scraped
+
+        The products skipped by a change-only scrape since `date_hard` (see `insert_temporal_products_data`) have no
+        new observation, they are found in the `unchanged_product_ids` of the stores and get the scrape parameters of
+        their last observation.
         """
-        cursor_distinct_products_fast = self.db[self.COLLECTION_NAME_PRODUCT_STORES_DATA].aggregate([
+        cursor_distinct_products_fast = self._get_collection(
+            self.COLLECTION_NAME_PRODUCT_STORES_DATA, call='get_products_to_scrape').aggregate([
             {"$match": {"$and": [{"market": market}, {
                 "last_updated": {"$gte": date_hard}}]}},
             # Group documents by product_id
@@ -378,22 +1226,47 @@ class DbInterface():
                 "last_updated": {"$max": "$last_updated"},
                 "scrape_parameters": {"$first": "$scrape_parameters"}}
              },
-        ])
-        cursor_product_ids_scraped = self.db[self.COLLECTION_NAME_PRODUCTS].distinct(
-            "_id", {"market": market})
+        ], **self._get_command_options('get_products_to_scrape'))
+        cursor_product_ids_scraped = self._get_collection(self.COLLECTION_NAME_PRODUCTS, call='get_products_to_scrape').distinct(
+            "_id", {"market": market}, **self._get_command_options('get_products_to_scrape'))
         products_ids_scraped = set(cursor_product_ids_scraped)
 
         products_scrape_parameters = []
         count_fast = 0
+        fast_product_ids = set()
         for product in cursor_distinct_products_fast:
             count_fast += 1
+            fast_product_ids.add(product['_id'])
             if product['_id'] not in products_ids_scraped:
                 products_scrape_parameters.append(product['scrape_parameters'])
 
+        stores = self._get_collection(self.COLLECTION_NAME_STORES, call='get_products_to_scrape').find(
+            {"market": market, "last_scraped": {"$gte": date_hard}}, {"_id": 0, "unchanged_product_ids": 1},
+            max_time_ms=self._get_max_time_ms('get_products_to_scrape'))
+        unchanged_product_ids = {product_id for store in stores for product_id in store.get('unchanged_product_ids') or []
+                                 if product_id not in fast_product_ids}
+        count_fast += len(unchanged_product_ids)
+        products_scrape_parameters += self._get_last_scrape_parameters(
+            [x for x in unchanged_product_ids if x not in products_ids_scraped])
+
         logging.info(
             f"Product prices scraped today: {count_fast}\nProduct that needs to be hard scraped: {len(products_scrape_parameters)}")
         return products_scrape_parameters
 
+    def _get_last_scrape_parameters(self, product_ids: list[str], chunk_size: int = 1000) -> list[dict]:
+        """Return the scrape parameters of the last observation of each product, in any store"""
+        collection = self._get_collection(self.COLLECTION_NAME_PRODUCT_STORES_DATA, call='get_products_to_scrape')
+        scrape_parameters = []
+        for i in range(0, len(product_ids), chunk_size):
+            products = collection.aggregate([
+                {"$match": {"timeseries_meta.product_id": {"$in": product_ids[i:i + chunk_size]}}},
+                {"$sort": SON([("last_updated", -1)])},
+                {"$group": {"_id": "$timeseries_meta.product_id",
+                            "scrape_parameters": {"$first": "$scrape_parameters"}}},
+            ], **self._get_command_options('get_products_to_scrape'))
+            scrape_parameters += [x['scrape_parameters'] for x in products]
+        return scrape_parameters
+
     def get_product_store_data_to_dump(self, days_to_skip: int, product_id: str) -> list[dict]:
         """
         Get the data from product_store_data for a given product older than 'days_to_skip' days ago
@@ -401,9 +1274,10 @@ class DbInterface():
         """
 
         date = datetime.now() - timedelta(days=days_to_skip if days_to_skip >= 0 else 0)
-        product_store_data = self.db[self.COLLECTION_NAME_PRODUCT_STORES_DATA].find(
+        product_store_data = self._get_collection(
+            self.COLLECTION_NAME_PRODUCT_STORES_DATA, call='get_product_store_data_to_dump').find(
             {
-                "product_id": product_id,
+                "timeseries_meta.product_id": product_id,
                 "last_updated": {"$lte": datetime(date.year, date.month, date.day)}
             },
             {
@@ -413,10 +1287,212 @@ class DbInterface():
                 "product_id": 1,
                 "store_universal_id": 1,
                 "last_updated": 1
-            }
+            },
+            max_time_ms=self._get_max_time_ms('get_product_store_data_to_dump')
         )
         return list(product_store_data)
 
+    PRICE_HISTORY_RESOLUTIONS = ('minute', 'hour', 'day', 'week', 'month', 'year')
+    PRICE_HISTORY_COLUMNS = ('product_id', 'store_universal_id', 'date',
+                             'min_price', 'max_price', 'last_price',
+                             'min_discounted_price', 'max_discounted_price', 'last_discounted_price')
+
+    def get_price_history(self, product_ids: list[str], store_ids: list[str], start: datetime, end: datetime,
+                          resolution: str = 'day', bin_size: int = 1, as_frame: bool = False) -> Union[Iterator[dict], pd.DataFrame]:
+        """Return the price history of the products in the stores between `start` (included) and `end` (excluded)
+
+        The observations are bucketed server side with `$dateTrunc` in buckets of `bin_size` `resolution`s, so at most
+        one point per (product, store, bucket) is returned with the min, max and last price and discounted price.
+        The points are sorted by product, store and date and are streamed from the cursor, or returned as a DataFrame
+        with the columns in `PRICE_HISTORY_COLUMNS` if `as_frame` is True.
+        Buckets without observations have no point, e.g. when the prices didn't change in a change-only scrape.
+        The days already rolled up by `rollup_daily_prices` are read from the daily collection, so they have at most
+        one point per day even with a finer resolution, a rolled up day is read whole even if `start` is in the middle
+        of it. A bucket with both rolled up and raw observations gets a single point, its last prices are the raw ones.
+        `$dateTrunc` requires MongoDB 5.0 or later.
+        """
+        if resolution not in self.PRICE_HISTORY_RESOLUTIONS:
+            raise ValueError(
+                f"Resolution `{resolution}` is not valid, it must be one of {self.PRICE_HISTORY_RESOLUTIONS}")
+
+        rolled_until = self._get_rolled_until(call='get_price_history')
+        raw_start = max(start, rolled_until) if rolled_until is not None else start
+        pipeline = [
+            {"$match": {"timeseries_meta.product_id": {"$in": product_ids},
+                        "timeseries_meta.store_universal_id": {"$in": store_ids},
+                        "last_updated": {"$gte": raw_start, "$lt": end}}},
+            {"$sort": SON([("last_updated", 1)])},
+            {"$group": {
+                "_id": {"product_id": "$timeseries_meta.product_id",
+                        "store_universal_id": "$timeseries_meta.store_universal_id",
+                        "date": {"$dateTrunc": {"date": "$last_updated", "unit": resolution, "binSize": bin_size}}},
+                "min_price": {"$min": "$price"},
+                "max_price": {"$max": "$price"},
+                "last_price": {"$last": "$price"},
+                "min_discounted_price": {"$min": "$discounted_price"},
+                "max_discounted_price": {"$max": "$discounted_price"},
+                "last_discounted_price": {"$last": "$discounted_price"}}
+             },
+        ]
+        if rolled_until is not None and start < rolled_until:
+            # the raw observations are more recent than the daily ones of the same bucket
+            pipeline.append({"$addFields": {"tier": 1}})
+            if resolution in ('minute', 'hour'):
+                date = "$date"
+            else:
+                date = {"$dateTrunc": {"date": "$date", "unit": resolution, "binSize": bin_size}}
+            pipeline.append({"$unionWith": {"coll": self.COLLECTION_NAME_PRODUCT_STORES_DATA_DAILY, "pipeline": [
+                {"$match": {"product_id": {"$in": product_ids},
+                            "store_universal_id": {"$in": store_ids},
+                            "date": {"$gte": datetime(start.year, start.month, start.day),
+                                     "$lt": min(end, rolled_until)}}},
+                {"$sort": SON([("date", 1)])},
+                {"$group": {
+                    "_id": {"product_id": "$product_id", "store_universal_id": "$store_universal_id", "date": date},
+                    "min_price": {"$min": "$min_price"},
+                    "max_price": {"$max": "$max_price"},
+                    "last_price": {"$last": "$close_price"},
+                    "min_discounted_price": {"$min": "$min_discounted_price"},
+                    "max_discounted_price": {"$max": "$max_discounted_price"},
+                    "last_discounted_price": {"$last": "$close_discounted_price"}}
+                 },
+                {"$addFields": {"tier": 0}},
+            ]}})
+            # merge the points of the buckets spanning both collections, e.g. a week with rolled up and raw days
+            pipeline += [
+                {"$sort": SON([("tier", 1)])},
+                {"$group": {
+                    "_id": "$_id",
+                    "min_price": {"$min": "$min_price"},
+                    "max_price": {"$max": "$max_price"},
+                    "last_price": {"$last": "$last_price"},
+                    "min_discounted_price": {"$min": "$min_discounted_price"},
+                    "max_discounted_price": {"$max": "$max_discounted_price"},
+                    "last_discounted_price": {"$last": "$last_discounted_price"}}
+                 },
+            ]
+        pipeline += [
+            {"$sort": SON([("_id.product_id", 1), ("_id.store_universal_id", 1), ("_id.date", 1)])},
+            {"$project": {
+                "_id": 0,
+                "product_id": "$_id.product_id",
+                "store_universal_id": "$_id.store_universal_id",
+                "date": "$_id.date",
+                **{column: 1 for column in self.PRICE_HISTORY_COLUMNS[3:]}}
+             },
+        ]
+        cursor = self._get_collection(self.COLLECTION_NAME_PRODUCT_STORES_DATA, call='get_price_history').aggregate(
+            pipeline, allowDiskUse=True, **self._get_command_options('get_price_history'))
+        if as_frame:
+            return pd.DataFrame.from_records(cursor, columns=self.PRICE_HISTORY_COLUMNS)
+        return cursor
+
+    def configure_retention(self, raw_retention_days: int):
+        """Let the raw observations of the time-series collection expire after `raw_retention_days` days
+
+        Run `rollup_daily_prices` more often than the retention period, or the expired days are lost.
+        """
+        self.db.command('collMod', self.COLLECTION_NAME_PRODUCT_STORES_DATA,
+                        expireAfterSeconds=raw_retention_days * 24 * 60 * 60)
+
+    def _get_rolled_until(self, call: str = None) -> datetime:
+        """Return the day after the last day rolled up by `rollup_daily_prices`, None if nothing was rolled up
+
+        `call` is the read method whose read settings are applied, if any
+        """
+        last_day = self._get_collection(self.COLLECTION_NAME_PRODUCT_STORES_DATA_DAILY, call=call).find_one(
+            {}, {'_id': 0, 'date': 1}, sort=[('date', pymongo.DESCENDING)],
+            max_time_ms=self._get_max_time_ms(call) if call is not None else None)
+        if last_day is None:
+            return None
+        return last_day['date'] + timedelta(days=1)
+
+    def rollup_daily_prices(self, older_than_days: int = 1, since: datetime = None) -> datetime:
+        """Roll the raw observations of the complete days older than `older_than_days` days up in the daily collection
+
+        Each daily document has the open, min, max and close price and discounted price of a (store, product, day),
+        and the close discount rate, label and product page uri.
+        The days after the last rolled up day are processed, or the days from `since` if given. The daily documents
+        are replaced, so the rollup can be run again on the same days.
+        Return the day up to which the observations are rolled up (excluded).
+        """
+        today = datetime.utcnow()
+        until = datetime(today.year, today.month, today.day) - timedelta(days=max(older_than_days, 0))
+        since = since or self._get_rolled_until()
+        match = {"last_updated": {"$lt": until}}
+        if since is not None:
+            match["last_updated"]["$gte"] = since
+
+        self.db[self.COLLECTION_NAME_PRODUCT_STORES_DATA].aggregate([
+            {"$match": match},
+            {"$sort": SON([("last_updated", 1)])},
+            {"$group": {
+                "_id": {"store_universal_id": "$timeseries_meta.store_universal_id",
+                        "product_id": "$timeseries_meta.product_id",
+                        "date": {"$dateTrunc": {"date": "$last_updated", "unit": "day"}}},
+                "open_price": {"$first": "$price"},
+                "min_price": {"$min": "$price"},
+                "max_price": {"$max": "$price"},
+                "close_price": {"$last": "$price"},
+                "open_discounted_price": {"$first": "$discounted_price"},
+                "min_discounted_price": {"$min": "$discounted_price"},
+                "max_discounted_price": {"$max": "$discounted_price"},
+                "close_discounted_price": {"$last": "$discounted_price"},
+                # the last observation of the day, read once the raw observations expired
+                "close_discount_rate": {"$last": "$discount_rate"},
+                "close_label": {"$last": "$label"},
+                "close_product_page_uri": {"$last": "$product_page_uri"},
+                "observations": {"$sum": 1}}
+             },
+            {"$addFields": {
+                "store_universal_id": "$_id.store_universal_id",
+                "product_id": "$_id.product_id",
+                "date": "$_id.date"}
+             },
+            {"$merge": {"into": self.COLLECTION_NAME_PRODUCT_STORES_DATA_DAILY,
+                        "whenMatched": "replace", "whenNotMatched": "insert"}},
+        ], allowDiskUse=True)
+        logging.info(f"Product store data rolled up until {until}")
+        return until
+
+    def export_market_products(self, market: str, path: str = None, batch_size: int = 10000):
+        """Export the products of a market in columnar format (see `columnar.product_schema`)
+
+        The cursor batches are decoded in Arrow record batches of `batch_size` rows. If `path` is given, they are
+        written one at a time to a Parquet file and the number of rows is returned, otherwise a DataFrame is returned.
+        """
+        cursor = self._get_collection(self.COLLECTION_NAME_PRODUCTS, call='export_market_products').find(
+            {"market": market}, batch_size=batch_size, max_time_ms=self._get_max_time_ms('export_market_products'))
+        return self._export_columnar(cursor, columnar.product_schema(), path, batch_size)
+
+    def export_product_store_data(self, market: str = None, start: datetime = None, end: datetime = None, path: str = None,
+                                  batch_size: int = 10000):
+        """Export the products data scraped between `start` (included) and `end` (excluded) in columnar format
+        (see `columnar.product_store_data_schema`), optionally only for a market. See `export_market_products`.
+        """
+        schema = columnar.product_store_data_schema()
+        filter_products_data = {}
+        if market is not None:
+            filter_products_data["market"] = market
+        if start is not None or end is not None:
+            filter_products_data["last_updated"] = {}
+            if start is not None:
+                filter_products_data["last_updated"]["$gte"] = start
+            if end is not None:
+                filter_products_data["last_updated"]["$lt"] = end
+        cursor = self._get_collection(self.COLLECTION_NAME_PRODUCT_STORES_DATA, call='export_product_store_data').find(
+            filter_products_data, {"_id": 0, **{name: 1 for name in schema.names}}, batch_size=batch_size,
+            max_time_ms=self._get_max_time_ms('export_product_store_data'))
+        return self._export_columnar(cursor, schema, path, batch_size)
+
+    def _export_columnar(self, cursor, schema, path: str, batch_size: int):
+        batches = columnar.iter_record_batches(cursor, schema, batch_size)
+        if path is not None:
+            rows = columnar.write_parquet(batches, schema, path)
+            logging.info(f"Exported {rows} rows to {path}")
+            return rows
+        return columnar.to_frame(batches, schema)
+
     def delete_dumped_product_store_data(self, days_to_skip: int, ids_to_avoid: list[str]):
         """
         Delete data in product_store_data older than days_to_skip days
@@ -426,7 +1502,7 @@ class DbInterface():
         date = datetime.now() - timedelta(days=days_to_skip if days_to_skip >= 0 else 0)
         return self.db[self.COLLECTION_NAME_PRODUCT_STORES_DATA].delete_many(
             {
-                "product_id": {"$nin": ids_to_avoid},
+                "timeseries_meta.product_id": {"$nin": ids_to_avoid},
                 "last_updated": {"$lte": datetime(date.year, date.month, date.day)}
             }
         )
@@ -0,0 +1,243 @@
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+import logging
+from pymongo import monitoring
+
+# operators whose field can be used as an equality prefix of an index
+EQUALITY_OPERATORS = ('$eq', '$in')
+# commands that read with a query plan, the getMore of their cursors are not recorded
+READ_COMMANDS = ('find', 'aggregate', 'distinct', 'count')
+
+
+@dataclass
+class QuerySpec:
+    """A read command sent by a DbInterface method, with the filter and sort that an index can serve"""
+    name: str
+    database: str
+    collection: str
+    command: dict
+    filter: dict
+    sort: list[tuple[str, int]] = field(default_factory=list)
+    projection: dict = None
+    distinct_key: str = None
+
+    @classmethod
+    def from_command(cls, name: str, database: str, command: dict) -> "QuerySpec":
+        command_name = next(iter(command))
+        spec = cls(name, database, command[command_name], _get_explainable_command(command), {})
+        if command_name == "find":
+            spec.filter = dict(command.get("filter", {}))
+            spec.sort = list(command.get("sort", {}).items())
+            spec.projection = command.get("projection")
+        elif command_name == "distinct":
+            spec.filter = dict(command.get("query", {}))
+            spec.distinct_key = command["key"]
+        elif command_name == "count":
+            spec.filter = dict(command.get("query", {}))
+        else:
+            # the index can serve the leading $match and the $sort that follows it
+            for stage in command["pipeline"]:
+                if "$match" in stage and not spec.filter:
+                    spec.filter = dict(stage["$match"])
+                elif "$sort" in stage:
+                    spec.sort = list(stage["$sort"].items())
+                    break
+                else:
+                    break
+        return spec
+
+
+# options added by the driver or not accepted inside an `explain` command
+DRIVER_FIELDS = ("lsid", "txnNumber", "readConcern", "maxTimeMS")
+
+
+def _get_explainable_command(command: dict) -> dict:
+    return {key: value for key, value in command.items() if not key.startswith("$") and key not in DRIVER_FIELDS}
+
+
+class CommandRecorder(monitoring.CommandListener):
+    """Record the read commands sent by a MongoClient, register it in the `event_listeners` of the client
+
+    Only the commands sent inside `recording` are recorded, with the name given to it.
+    """
+
+    def __init__(self):
+        self.specs: list[QuerySpec] = []
+        self._name: str = None
+
+    @contextmanager
+    def recording(self, name: str):
+        self._name = name
+        try:
+            yield
+        finally:
+            self._name = None
+
+    def started(self, event):
+        if self._name is not None and event.command_name in READ_COMMANDS:
+            self.specs.append(QuerySpec.from_command(self._name, event.database_name, event.command))
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+
+@dataclass
+class QueryPlanReport:
+    name: str
+    collection: str
+    stages: list[str]
+    collection_scan: bool
+    in_memory_sort: bool
+    suggested_index: list[tuple[str, int]]
+
+    @property
+    def ok(self) -> bool:
+        return not self.collection_scan and not self.in_memory_sort
+
+    def __str__(self):
+        problems = [p for p, found in (("COLLSCAN", self.collection_scan), ("in-memory SORT", self.in_memory_sort)) if found]
+        if not problems:
+            return f"{self.name}: ok ({' > '.join(self.stages)})"
+        return (f"{self.name}: {', '.join(problems)} ({' > '.join(self.stages)}), "
+                f"suggested index on {self.collection}: {self.suggested_index}")
+
+
+def capture_queries(db_interface, recorder: CommandRecorder, market: str, store_id: str, product_ids: list[str],
+                    postal_code: str, date: datetime = None) -> list[QuerySpec]:
+    """Run the DbInterface read methods with the given sample values and return the commands they sent
+
+    `recorder` must be registered in the `event_listeners` of the client of `db_interface`
+    """
+    db = db_interface
+    date = date or datetime.utcnow() - timedelta(days=1)
+    calls = {
+        "get_market_products": lambda: db.get_market_products(market),
+        "get_market_stores": lambda: db.get_market_stores(market),
+        "get_available_markets": lambda: db.get_available_markets(postal_code, 0, 0),
+        "get_cheapest_offers": lambda: db.get_cheapest_offers(postal_code, product_ids),
+        "get_store_products_ids": lambda: db.get_store_products_ids(store_id),
+        "get_prices": lambda: db.get_prices(product_ids, store_id),
+        "get_most_recent_products": lambda: db.get_most_recent_products(store_id, product_ids),
+        "get_products_data_by_store": lambda: db.get_products_data_by_store(store_id),
+        "get_products_to_scrape": lambda: db.get_products_to_scrape(market, date),
+        "get_product_store_data_to_dump": lambda: db.get_product_store_data_to_dump(1, product_ids[0]),
+        "get_price_history": lambda: list(db.get_price_history(product_ids, [store_id], date - timedelta(days=30), date)),
+    }
+    recorder.specs = []
+    for name, call in calls.items():
+        with recorder.recording(name):
+            call()
+    return recorder.specs
+
+
+# parts of the explain output that are not stages of the winning plan
+SKIPPED_EXPLAIN_KEYS = ('rejectedPlans', 'command', 'parsedQuery')
+
+
+def _get_winning_stages(explain) -> list[str]:
+    """Return the stages of the winning plans found anywhere in the explain output, in execution order"""
+    stages = []
+    if isinstance(explain, dict):
+        for key, value in explain.items():
+            if key in SKIPPED_EXPLAIN_KEYS:
+                continue
+            stages.extend(_get_winning_stages(value))
+            # aggregation stages that were not pushed down to the query layer, e.g. {"$sort": {...}}
+            if key.startswith("$") and key != "$cursor" and isinstance(value, dict):
+                stages.append(key)
+        # the input stages of a plan stage run before it
+        if isinstance(explain.get("stage"), str):
+            stages.append(explain["stage"])
+    elif isinstance(explain, list):
+        for value in explain:
+            stages.extend(_get_winning_stages(value))
+    return stages
+
+
+def _has_blocking_sort(stages: list[str]) -> bool:
+    """Return True if the documents are sorted in memory before they are grouped
+
+    The sort of the groups, e.g. by the `_id` of a `$group`, can't use an index and is not reported
+    """
+    for stage in stages:
+        if stage in ("GROUP", "$group"):
+            return False
+        if stage in ("SORT", "$sort"):
+            return True
+    return False
+
+
+def _flatten_filter(filter_mongo: dict) -> dict:
+    flat = {}
+    for key, value in filter_mongo.items():
+        if key == "$and":
+            for condition in value:
+                flat.update(_flatten_filter(condition))
+        elif not key.startswith("$"):
+            flat[key] = value
+    return flat
+
+
+def suggest_index(spec: QuerySpec) -> list[tuple[str, int]]:
+    """Suggest an index following the Equality, Sort, Range rule, covering the projected fields if any"""
+    equality = []
+    ranges = []
+    for key, value in _flatten_filter(spec.filter).items():
+        if isinstance(value, dict) and not all(op in EQUALITY_OPERATORS for op in value):
+            ranges.append((key, 1))
+        else:
+            equality.append((key, 1))
+    index = equality + [x for x in spec.sort if x[0] not in dict(equality)]
+    index += [x for x in ranges if x[0] not in dict(index)]
+    if spec.distinct_key is not None and spec.distinct_key not in dict(index):
+        index.append((spec.distinct_key, 1))
+    if spec.projection:
+        index += [(key, 1) for key, value in spec.projection.items()
+                  if value and key != "_id" and key not in dict(index)]
+    return index
+
+
+def explain_queries(db_interface, specs: list[QuerySpec]) -> list[QueryPlanReport]:
+    """Explain every recorded command and report the collection scans and the in-memory sorts"""
+    client = db_interface.db.client
+    reports = []
+    for spec in specs:
+        explain = client[spec.database].command("explain", spec.command, verbosity="queryPlanner")
+        stages = _get_winning_stages(explain)
+        reports.append(QueryPlanReport(
+            name=spec.name,
+            collection=spec.collection,
+            stages=stages,
+            collection_scan="COLLSCAN" in stages,
+            in_memory_sort=_has_blocking_sort(stages),
+            suggested_index=suggest_index(spec),
+        ))
+    return reports
+
+
+if __name__ == "__main__":
+    import os
+    import sys
+    import pymongo
+    from dotenv import load_dotenv
+    from db_interface.db_interface import DbInterface
+
+    if len(sys.argv) < 5:
+        print("Usage: python -m db_interface.index_advisor <market> <store_id> <product_id> <postal_code>")
+        sys.exit(1)
+    logging.basicConfig(level=logging.INFO)
+    load_dotenv()
+    recorder = CommandRecorder()
+    client = pymongo.MongoClient(os.getenv("COSMOS_CONNECTION_STRING"), event_listeners=[recorder])
+    db_interface = DbInterface(db_connection=client[os.getenv("MONGO_DATABASE")],
+                               db_connection_misc=client[os.getenv("MONGO_MISC_DATABASE")])
+    reports = explain_queries(db_interface, capture_queries(
+        db_interface, recorder, sys.argv[1], sys.argv[2], [sys.argv[3]], sys.argv[4]))
+    for report in reports:
+        print(report)
+    db_interface.close()
+    sys.exit(0 if all(r.ok for r in reports) else 1)
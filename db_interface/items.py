@@ -4,10 +4,13 @@
 # https://docs.scrapy.org/en/latest/topics/items.html
 
 from scrapy.item import Item, Field
-from dataclasses import dataclass, fields
+from dataclasses import dataclass, fields, asdict
 from typing import Optional
+from datetime import datetime
+from functools import lru_cache
 import inspect
 import hashlib
+import json
 
 
 def from_dict_to_dataclass(cls, data):
@@ -35,15 +38,39 @@ def compute_location_id(geo_points: list[GeoPoint]) -> str:
     if isinstance(geo_points[0], dict):
         if geo_points[0].get("postal_code") is None:
             raise TypeError("In order to compute the location id a list of GeoPoint or a list of dict with the field `postal_code` is needed")
-        postal_codes = list(map(lambda x: x["postal_code"], geo_points))
+        postal_codes = [x["postal_code"] for x in geo_points]
     else:
-        postal_codes = list(map(lambda x: x.postal_code, geo_points))
-    postal_codes.sort()
+        postal_codes = [x.postal_code for x in geo_points]
+    return compute_location_ids([postal_codes])[0]
 
-    location_id = hashlib.md5()
-    for p in postal_codes:
-        location_id.update(bytes(str(p), encoding='utf-8'))
-    return location_id.hexdigest()
+
+@lru_cache(maxsize=65536)
+def _compute_location_id(postal_codes: tuple[str]) -> str:
+    # the same as feeding the sorted postal codes to md5 one at a time
+    return hashlib.md5(bytes("".join(sorted(postal_codes)), encoding='utf-8')).hexdigest()
+
+
+def compute_location_ids(groups: list[list[str]]) -> list[str]:
+    """Return the location id of each group of postal codes, the ids are memoized by group"""
+    return [_compute_location_id(tuple(str(p) for p in postal_codes)) for postal_codes in groups]
+
+
+def compute_product_hash(item: "ProductItem") -> str:
+    """Stable hash of the content of a ProductItem, used to detect if a product changed since the last scrape"""
+    item = asdict(item) if not isinstance(item, dict) else dict(item)
+    for field in ("last_updated", "content_hash"):
+        item.pop(field, None)
+    content = json.dumps(item, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.md5(bytes(content, encoding='utf-8')).hexdigest()
+
+
+def compute_observation_id(store_universal_id: str, product_id: str, last_updated: datetime) -> str:
+    """Deterministic id of a price observation, the same scrape of a product in a store always gets the same id
+
+    The scrape time is truncated to milliseconds like the BSON datetimes, so the id doesn't change once stored
+    """
+    content = f"{store_universal_id}|{product_id}|{last_updated.isoformat(timespec='milliseconds')}"
+    return hashlib.md5(bytes(content, encoding='utf-8')).hexdigest()
 
 
 @dataclass
@@ -124,5 +151,5 @@ class ProductItem:
     # all information one can find like characteristics, ingredients, allergens, certification, etc..
     informations: dict[str, str] = None
     meta: Optional[dict] = None
-    # this code is unique globally. It is formatted as `{market}_{code}` and it is automatically added in `pipeline.py`
+    # this code is unique globally. It is formatted as `{code}_{market}` and it is automatically added in `pipelines.py`
     _id: str = None
@@ -0,0 +1,84 @@
+import os
+import threading
+import uuid
+from bson import json_util
+
+
+class WriteJournal():
+    """Append-only NDJSON journal of the write batches of DbInterface
+
+    A batch is spilled to the file before it is written to the db and acknowledged once the db confirmed it, so the
+    batches still pending after a crash can be replayed with `DbInterface.resume_journal`. The values are encoded with
+    `bson.json_util`, so the datetimes are read back as datetimes.
+    """
+
+    def __init__(self, path: str, compact_every: int = 1000):
+        self.path = path
+        # the acknowledged batches are dropped from the file every `compact_every` acknowledgements
+        self.compact_every = compact_every
+        self._acks = 0
+        self._lock = threading.Lock()
+
+    def _append(self, entry: dict):
+        # the caller holds the lock
+        line = json_util.dumps(entry) + "\n"
+        with open(self.path, "a", encoding="utf-8") as f_out:
+            f_out.write(line)
+            f_out.flush()
+            os.fsync(f_out.fileno())
+
+    def append(self, method: str, kwargs: dict) -> str:
+        """Spill a batch of the write method `method` called with `kwargs` and return its id"""
+        batch_id = uuid.uuid4().hex
+        with self._lock:
+            self._append({"batch_id": batch_id, "method": method, "kwargs": kwargs})
+        return batch_id
+
+    def ack(self, batch_id: str):
+        with self._lock:
+            self._append({"ack": batch_id})
+            self._acks += 1
+            if self._acks >= self.compact_every:
+                self._compact()
+
+    def _read_pending(self) -> list[dict]:
+        # the caller holds the lock
+        if not os.path.exists(self.path):
+            return []
+        batches = {}
+        with open(self.path, encoding="utf-8") as f_in:
+            for line in f_in:
+                if not line.strip():
+                    continue
+                try:
+                    entry = json_util.loads(line)
+                except ValueError:
+                    # the last line is truncated if the worker crashed while writing it
+                    continue
+                if "ack" in entry:
+                    batches.pop(entry["ack"], None)
+                else:
+                    batches[entry["batch_id"]] = entry
+        return list(batches.values())
+
+    def pending(self) -> list[dict]:
+        """Return the batches not acknowledged yet, in the order they were spilled"""
+        with self._lock:
+            return self._read_pending()
+
+    def _compact(self):
+        # the caller holds the lock, so no batch is spilled while the file is rewritten
+        batches = self._read_pending()
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f_out:
+            for batch in batches:
+                f_out.write(json_util.dumps(batch) + "\n")
+            f_out.flush()
+            os.fsync(f_out.fileno())
+        os.replace(tmp_path, self.path)
+        self._acks = 0
+
+    def compact(self):
+        """Rewrite the journal with only the pending batches"""
+        with self._lock:
+            self._compact()
@@ -0,0 +1,83 @@
+import logging
+import threading
+import pymongo
+
+
+class MarketsStore():
+    """In-memory copy of the markets collection indexed by `name_lower`
+
+    The markets are loaded once and reloaded when the collection changes. Changes are detected with a change stream,
+    or by polling the number of markets and the most recent `last_updated` when change streams are not available.
+    """
+
+    def __init__(self, collection, poll_interval: float = 60, use_change_stream: bool = True):
+        self.collection = collection
+        self.poll_interval = poll_interval
+        self.use_change_stream = use_change_stream
+
+        self._markets: dict[str, dict] = {}
+        self._watermark = None
+        self._stop = threading.Event()
+        self._thread: threading.Thread = None
+        self.load()
+
+    def load(self):
+        """Reload all the markets from the db"""
+        # read before the markets, so a change made while they are read triggers another reload
+        watermark = self._get_watermark()
+        markets = {}
+        for market in self.collection.find({}, {'_id': 0}):
+            markets[market['name_lower']] = market
+        # the dict is replaced at once, readers see either the old or the new markets
+        self._markets = markets
+        self._watermark = watermark
+        logging.info(f"Markets loaded: {len(markets)}")
+
+    def _get_watermark(self) -> tuple:
+        last_market = self.collection.find_one(
+            {}, {'_id': 0, 'last_updated': 1}, sort=[('last_updated', pymongo.DESCENDING)])
+        last_updated = last_market.get('last_updated') if last_market is not None else None
+        return self.collection.count_documents({}), last_updated
+
+    def get(self, names: list[str] = None) -> list[dict]:
+        """Return a copy of the markets with the given `name_lower`, or all the markets if `names` is None"""
+        markets = self._markets
+        if names is None:
+            return [dict(x) for x in markets.values()]
+        return [dict(markets[name]) for name in names if name in markets]
+
+    def start(self):
+        """Keep the markets updated from a background thread"""
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._watch, name="markets-store", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _watch(self):
+        if self.use_change_stream:
+            try:
+                with self.collection.watch(max_await_time_ms=1000) as stream:
+                    # the changes made before the stream was opened are not in the stream
+                    self.load()
+                    while not self._stop.is_set():
+                        if stream.try_next() is not None:
+                            self.load()
+                return
+            except pymongo.errors.PyMongoError as e:
+                logging.warning(f"Change stream on markets not available, falling back to polling: {e}")
+        self._poll()
+
+    def _poll(self):
+        while not self._stop.wait(self.poll_interval):
+            try:
+                if self._get_watermark() != self._watermark:
+                    self.load()
+            except pymongo.errors.PyMongoError as e:
+                logging.warning(f"Markets refresh failed: {e}")
@@ -0,0 +1,207 @@
+# Scrapy item pipeline writing the scraped items with DbInterface
+#
+# Enable it in the settings of the scrapy project:
+#     ITEM_PIPELINES = {"db_interface.pipelines.DbInterfacePipeline": 300}
+#
+# See documentation in:
+# https://docs.scrapy.org/en/latest/topics/item-pipeline.html
+
+from db_interface.db_interface import DbInterface
+from db_interface.items import ProductStoreDataItem, ProductItem, LocationItem, StoreItem
+from db_interface.batch import ProductStoreDataBatch
+from twisted.internet import threads
+from twisted.internet.defer import DeferredList
+from twisted.internet.task import LoopingCall
+from datetime import datetime
+import logging
+
+
+class DbInterfacePipeline:
+    """Batch the scraped StoreItem, ProductItem and ProductStoreDataItem and write them with DbInterface
+
+    The ids that the spiders leave empty are set here:
+    - StoreItem `_id` as `{store_id}_{market}_{service}`
+    - ProductItem `_id` and ProductStoreDataItem `product_id` as `{code}_{market}`
+    - ProductStoreDataItem `store_universal_id` and `store_id` from the `_id` and `store_id` of `spider.input_params`
+    The stores are grouped in the LocationItem built from the `postal_codes` of `spider.input_params`, the products data
+    are buffered per store in a `ProductStoreDataBatch`. The stores are written in batches, their locations are
+    written once with all the stores scraped by the spider when it is closed.
+
+    The items are written when `DB_PIPELINE_BATCH_SIZE` items of a kind are buffered, every `DB_PIPELINE_FLUSH_INTERVAL`
+    seconds and when the spider is closed. The writes run in the reactor thread pool, when `DB_PIPELINE_MAX_PENDING_WRITES`
+    writes are running the items are not released until one of them completes, slowing down the crawl.
+    If `DB_PIPELINE_JOURNAL_PATH` is set, the batches are spilled to that file until the db acknowledges them and the
+    batches left by a crashed crawl are written when the spider is opened (see `DbInterface.resume_journal`).
+    """
+
+    def __init__(self, batch_size: int = 1000, flush_interval: float = 10, max_pending_writes: int = 2,
+                 journal_path: str = None):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_pending_writes = max_pending_writes
+        self.journal_path = journal_path
+
+        self.db: DbInterface = None
+        self.input_params: dict = {}
+        # <postal_codes>: list[StoreItem]
+        self._stores: dict[tuple[str], list[StoreItem]] = {}
+        self._stores_count = 0
+        # <postal_codes>: {<market>: [<store_ids>]} of all the stores scraped by the spider
+        self._locations: dict[tuple[str], dict[str, list[str]]] = {}
+        self._products: list[ProductItem] = []
+        # <store_universal_id>: ProductStoreDataBatch
+        self._products_data: dict[str, ProductStoreDataBatch] = {}
+        self._products_data_count = 0
+        # <store_universal_id>: scrape time shared by all the writes of the store
+        self._scrape_times: dict[str, datetime] = {}
+        self._pending = set()
+        self._pending_stores = set()
+        self._loop: LoopingCall = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        settings = crawler.settings
+        return cls(
+            batch_size=settings.getint("DB_PIPELINE_BATCH_SIZE", 1000),
+            flush_interval=settings.getfloat("DB_PIPELINE_FLUSH_INTERVAL", 10),
+            max_pending_writes=settings.getint("DB_PIPELINE_MAX_PENDING_WRITES", 2),
+            journal_path=settings.get("DB_PIPELINE_JOURNAL_PATH"),
+        )
+
+    def open_spider(self, spider):
+        self.db = DbInterface(journal_path=self.journal_path)
+        if self.journal_path is not None:
+            replayed = self.db.resume_journal()
+            if replayed:
+                logging.info(f"DbInterfacePipeline: {replayed} batches of a previous crawl written")
+        self.input_params = getattr(spider, "input_params", None) or {}
+        self._loop = LoopingCall(self.flush)
+        self._loop.start(self.flush_interval, now=False)
+
+    def close_spider(self, spider):
+        if self._loop is not None and self._loop.running:
+            self._loop.stop()
+        self.flush()
+        d = DeferredList(list(self._pending), consumeErrors=True)
+        d.addCallback(lambda _: self._write_locations())
+        d.addBoth(lambda _: self.db.close())
+        return d
+
+    def process_item(self, item, spider):
+        if isinstance(item, StoreItem):
+            if item._id is None:
+                item._id = f"{item.store_id}_{item.market}_{item.service}"
+            postal_codes = self.input_params.get("postal_codes")
+            if not postal_codes:
+                raise ValueError(
+                    "StoreItem can't be saved, `postal_codes` is missing in `spider.input_params`")
+            postal_codes = tuple(sorted(postal_codes))
+            self._stores.setdefault(postal_codes, []).append(item)
+            self._stores_count += 1
+            market_store_ids = self._locations.setdefault(postal_codes, {}).setdefault(item.market, [])
+            if item._id not in market_store_ids:
+                market_store_ids.append(item._id)
+            if self._stores_count >= self.batch_size:
+                self._flush_stores()
+        elif isinstance(item, ProductItem):
+            if item._id is None:
+                item._id = f"{item.code}_{item.market}"
+            self._products.append(item)
+            if len(self._products) >= self.batch_size:
+                self._flush_products()
+        elif isinstance(item, ProductStoreDataItem):
+            if item.product_id is None:
+                item.product_id = f"{item.code}_{item.market}"
+            if item.store_universal_id is None:
+                item.store_universal_id = self.input_params.get("_id")
+                item.store_id = self.input_params.get("store_id")
+            if item.store_universal_id is None:
+                raise ValueError(
+                    "ProductStoreDataItem can't be saved, `_id` is missing in `spider.input_params`")
+            self._scrape_times.setdefault(item.store_universal_id, datetime.utcnow())
+            if item.store_universal_id not in self._products_data:
+                self._products_data[item.store_universal_id] = ProductStoreDataBatch()
+            self._products_data[item.store_universal_id].append(item)
+            self._products_data_count += 1
+            if self._products_data_count >= self.batch_size:
+                self._flush_products_data()
+        else:
+            return item
+
+        return self._wait_pending_writes(item)
+
+    def flush(self):
+        """Write all the buffered items"""
+        self._flush_stores()
+        self._flush_products()
+        self._flush_products_data()
+
+    def _flush_stores(self):
+        if self._stores_count == 0:
+            return
+        groups = [(LocationItem(postal_codes=list(postal_codes)), stores)
+                  for postal_codes, stores in self._stores.items()]
+        self._stores = {}
+        self._stores_count = 0
+        d = self._write(self.db.upsert_store_items_batch, groups, update_locations=False)
+        self._pending_stores.add(d)
+        d.addBoth(lambda _: self._pending_stores.discard(d))
+
+    def _write_locations(self):
+        if not self._locations:
+            return None
+        locations = [LocationItem(postal_codes=list(postal_codes), markets=markets)
+                     for postal_codes, markets in self._locations.items()]
+        self._locations = {}
+        return self._write(self.db.upsert_location_items, locations)
+
+    def _flush_products(self):
+        if len(self._products) == 0:
+            return
+        products = self._products
+        self._products = []
+        self._write(self.db.upsert_product_items, products)
+
+    def _flush_products_data(self):
+        if self._products_data_count == 0:
+            return
+        products_data = self._products_data
+        self._products_data = {}
+        self._products_data_count = 0
+
+        # the stores must exist before their `last_scraped` is updated
+        self._flush_stores()
+        if self._pending_stores:
+            d = DeferredList(list(self._pending_stores), consumeErrors=True)
+            d.addCallback(lambda _: self._write_products_data(products_data))
+            self._track(d)
+        else:
+            self._write_products_data(products_data)
+
+    def _write_products_data(self, products_data: dict[str, ProductStoreDataBatch]) -> DeferredList:
+        return DeferredList([
+            self._write(self.db.insert_temporal_products_data, items, store_universal_id,
+                        last_updated=self._scrape_times[store_universal_id])
+            for store_universal_id, items in products_data.items()
+        ])
+
+    def _write(self, write, *args, **kwargs):
+        """Run the write in the reactor thread pool"""
+        d = threads.deferToThread(write, *args, **kwargs)
+        d.addErrback(lambda failure: logging.error(
+            f"DbInterfacePipeline: {write.__name__} failed: {failure.getErrorMessage()}"))
+        return self._track(d)
+
+    def _track(self, d):
+        """Keep track of the running write until it completes"""
+        self._pending.add(d)
+        d.addBoth(lambda _: self._pending.discard(d))
+        return d
+
+    def _wait_pending_writes(self, item):
+        """Return the item, or a deferred firing with the item when a write completes if too many writes are running"""
+        if len(self._pending) < self.max_pending_writes:
+            return item
+        d = DeferredList(list(self._pending), fireOnOneCallback=True, consumeErrors=True)
+        d.addCallback(lambda _: item)
+        return d
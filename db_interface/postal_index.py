@@ -0,0 +1,136 @@
+import logging
+from array import array
+from datetime import datetime
+from math import radians
+import numpy as np
+from db_interface.items import compute_location_ids
+
+SERVICES = ('delivery', 'pickup')
+
+
+class PostalCodeIndex():
+    """Compact in-memory index from postal codes to the stores available there
+
+    Each store is encoded with an integer, its coordinates, market and service are kept in parallel arrays indexed
+    by that integer. Each location (identified by its `location_id`) maps every market to an array of store
+    integers, and each postal code maps to the locations containing it. Only `lat` and `long` of the store geo points
+    are kept.
+    """
+
+    def __init__(self):
+        self.store_ids: list[str] = []
+        self.store_names: list[str] = []
+        self._store_index: dict[str, int] = {}
+        self.lat = array('d')
+        self.lon = array('d')
+        self.market_codes = array('H')
+        self.service_codes = array('B')
+        self.markets: list[str] = []
+        self._market_index: dict[str, int] = {}
+        # <location_id>: {<market_code>: array(<store_index>)}
+        self._locations: dict[str, dict[int, array]] = {}
+        # <postal_code>: list[<location_id>]
+        self._postal_codes: dict[str, list[str]] = {}
+
+    @classmethod
+    def build(cls, locations_collection, stores_collection) -> "PostalCodeIndex":
+        index = cls()
+        index.add_stores(stores_collection.find(
+            {}, {'_id': 1, 'market': 1, 'name': 1, 'service': 1, 'geo_point.lat': 1, 'geo_point.long': 1}))
+        # the most recently updated document of each location is kept, the others are stale duplicates
+        locations = {}
+        for location in locations_collection.find({}, {'_id': 0, 'postal_codes': 1, 'markets': 1, 'last_updated': 1}):
+            location_id = compute_location_ids([location['postal_codes']])[0]
+            if location_id not in locations or (location.get('last_updated') or datetime.min) > (
+                    locations[location_id].get('last_updated') or datetime.min):
+                locations[location_id] = location
+        for location in locations.values():
+            for market, store_ids in (location.get('markets') or {}).items():
+                index.set_location(location['postal_codes'], market, store_ids)
+        logging.info(
+            f"Postal code index built: {len(index.store_ids)} stores, {len(index._postal_codes)} postal codes")
+        return index
+
+    def _get_market_code(self, market: str) -> int:
+        if market not in self._market_index:
+            self._market_index[market] = len(self.markets)
+            self.markets.append(market)
+        return self._market_index[market]
+
+    def add_stores(self, stores):
+        """Add or update the stores, given as dicts with the fields `_id`, `market`, `name`, `service` and `geo_point`"""
+        for store in stores:
+            geo_point = store.get('geo_point') or {}
+            lat = float(geo_point['lat']) if geo_point.get('lat') is not None else float('nan')
+            lon = float(geo_point['long']) if geo_point.get('long') is not None else float('nan')
+            market_code = self._get_market_code(store['market'])
+            service_code = SERVICES.index(store['service']) if store.get('service') in SERVICES else len(SERVICES)
+
+            i = self._store_index.get(store['_id'])
+            if i is None:
+                self._store_index[store['_id']] = len(self.store_ids)
+                self.store_ids.append(store['_id'])
+                self.store_names.append(store.get('name'))
+                self.lat.append(lat)
+                self.lon.append(lon)
+                self.market_codes.append(market_code)
+                self.service_codes.append(service_code)
+            else:
+                self.store_names[i] = store.get('name')
+                self.lat[i] = lat
+                self.lon[i] = lon
+                self.market_codes[i] = market_code
+                self.service_codes[i] = service_code
+
+    def set_location(self, postal_codes: list[str], market: str, store_ids: list[str]):
+        """Replace the stores of a market for a location, unknown stores are ignored"""
+        location = compute_location_ids([postal_codes])[0]
+        if location not in self._locations:
+            self._locations[location] = {}
+            for postal_code in postal_codes:
+                self._postal_codes.setdefault(postal_code, []).append(location)
+        self._locations[location][self._get_market_code(market)] = array(
+            'I', [self._store_index[x] for x in store_ids if x in self._store_index])
+
+    def lookup(self, postal_code: str, lat: float, lon: float) -> dict[str, list[dict]]:
+        """Return {<market>: <stores>} with the stores available for the postal code sorted by distance from (lat, lon)
+
+        Each store is a dict like the ones returned by `DbInterface.get_available_markets`
+        """
+        markets_stores = {}
+        for location in self._postal_codes.get(postal_code, []):
+            for market_code, store_indexes in self._locations[location].items():
+                markets_stores.setdefault(market_code, set()).update(store_indexes)
+
+        result = {}
+        for market_code, store_indexes in markets_stores.items():
+            store_indexes = np.fromiter(store_indexes, dtype=np.int64, count=len(store_indexes))
+            distances = self._compute_distances(store_indexes, lat, lon)
+            order = np.argsort(distances, kind='stable')
+            result[self.markets[market_code]] = [self._get_store(int(i), float(d))
+                                                 for i, d in zip(store_indexes[order], distances[order])]
+        return result
+
+    def _compute_distances(self, store_indexes: np.ndarray, lat: float, lon: float) -> np.ndarray:
+        """Vectorized version of the distance used by `DbInterface.get_available_markets`"""
+        lat_stores = np.radians(np.frombuffer(self.lat, dtype=np.float64)[store_indexes])
+        lon_stores = np.radians(np.frombuffer(self.lon, dtype=np.float64)[store_indexes])
+        x = (lon_stores - radians(lon)) * np.cos(0.5 * (lat_stores + radians(lat)))
+        y = lat_stores - radians(lat)
+        distances = np.round(6371 * np.sqrt(x * x + y * y), 2)
+        distances[np.isnan(distances)] = 9999
+        return distances
+
+    def _get_store(self, i: int, distance: float) -> dict:
+        service_code = self.service_codes[i]
+        geo_point = None
+        if not np.isnan(self.lat[i]):
+            geo_point = {'lat': self.lat[i], 'long': self.lon[i]}
+        return {
+            '_id': self.store_ids[i],
+            'market': self.markets[self.market_codes[i]],
+            'name': self.store_names[i],
+            'geo_point': geo_point,
+            'service': SERVICES[service_code] if service_code < len(SERVICES) else None,
+            'distance': distance,
+        }
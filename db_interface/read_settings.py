@@ -0,0 +1,42 @@
+from dataclasses import dataclass
+from pymongo.read_preferences import _ServerMode, SecondaryPreferred, Primary
+from pymongo.read_concern import ReadConcern
+
+SERVING = "serving"
+ANALYTICS = "analytics"
+
+# Call class of each DbInterface read method
+READ_CALL_CLASSES = {
+    "get_prices": SERVING,
+    "get_available_markets": SERVING,
+    "get_cheapest_offers": SERVING,
+    "get_markets": SERVING,
+    "get_market_stores": SERVING,
+    "get_most_recent_products": SERVING,
+    "get_geo_points": SERVING,
+    "get_stores": SERVING,
+    "get_market_products": ANALYTICS,
+    "get_store_products_ids": ANALYTICS,
+    "get_products_data_by_store": ANALYTICS,
+    "get_products_to_scrape": ANALYTICS,
+    "get_product_store_data_to_dump": ANALYTICS,
+    "get_price_history": ANALYTICS,
+    "export_market_products": ANALYTICS,
+    "export_product_store_data": ANALYTICS,
+}
+
+
+@dataclass
+class ReadSettings:
+    """Read preference, read concern and time budget of a read, None keeps the default of the connection"""
+    read_preference: _ServerMode = None
+    read_concern: ReadConcern = None
+    max_time_ms: int = None
+
+
+# Presets, e.g. DbInterface(read_settings={SERVING: SERVING_READ_SETTINGS, ANALYTICS: ANALYTICS_READ_SETTINGS})
+# serving reads stay on the primary with a strict time budget
+SERVING_READ_SETTINGS = ReadSettings(read_preference=Primary(), max_time_ms=2000)
+# analytics reads go to a secondary at most 2 minutes behind the primary, if any
+ANALYTICS_READ_SETTINGS = ReadSettings(read_preference=SecondaryPreferred(max_staleness=120),
+                                       read_concern=ReadConcern("local"), max_time_ms=10 * 60 * 1000)
@@ -10,5 +10,6 @@ setup(
     license='unlicense',
     packages=['db_interface', 'blob_interface'],
     install_requires=['pymongo', 'python-dotenv', 'bson', 'pandas', 'scrapy', 'azure-storage-blob'],
+    extras_require={'columnar': ['pyarrow']},
     zip_safe=False
 )
\ No newline at end of file
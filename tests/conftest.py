@@ -2,6 +2,14 @@ import sys
 import os
 sys.path.append(os.getcwd())
 
-from pytest_mock_resources import create_mongo_fixture
+import pytest
+from pytest_mock_resources import create_mongo_fixture, MongoConfig
+
+
+@pytest.fixture(scope="session")
+def pmr_mongo_config():
+    # $dateTrunc (price history and rollup) needs MongoDB 5.0, the default image is mongo:3.6
+    return MongoConfig(image="mongo:5.0")
+
 
 mongo_db = create_mongo_fixture()
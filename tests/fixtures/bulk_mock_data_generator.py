@@ -0,0 +1,269 @@
+from db_interface.items import LocationItem, ProductItem, GeoPoint, StoreItem, ProductStoreDataItem
+from fixtures.mock_data_generator import ALL_MARKETS, ALL_UNITS, product_names, product_variants, generate_geo_point
+import fixtures.mock_data_generator as mock_data_generator
+from faker import Faker
+from dataclasses import asdict
+from datetime import datetime, timedelta
+from typing import Iterator
+import numpy as np
+import json
+import os
+
+SERVICES = ("delivery", "pickup")
+
+
+class BulkMockDataGenerator:
+    """Seeded generator of production-scale mock data
+
+    Faker is only used once to fill small pools of values (addresses, brands, uris, ...).
+    Every item is then assembled by sampling those pools with vectorized numpy draws,
+    so the same seed always produces the same stores, products and price history.
+    """
+
+    def __init__(self, seed: int = 0, markets: tuple[str] = ALL_MARKETS, stores_per_market: int = 50,
+                 products_per_market: int = 1000, scrape_days: int = 30, price_change_rate: float = 0.1,
+                 postal_codes_count: int = 5, pool_size: int = 500, start_date: datetime = None):
+        if not 0 <= price_change_rate <= 1:
+            raise ValueError("price_change_rate must be between 0 and 1")
+
+        self.markets = tuple(markets)
+        self.stores_per_market = stores_per_market
+        self.products_per_market = products_per_market
+        self.scrape_days = scrape_days
+        self.price_change_rate = price_change_rate
+        self.postal_codes_count = postal_codes_count
+        self.start_date = start_date if start_date is not None else datetime(2023, 1, 1)
+
+        self.seed = seed
+        self.rng = np.random.default_rng(seed)
+        self.fake = Faker('it_IT')
+        self.fake.seed_instance(seed)
+        self._init_pools(pool_size)
+
+        self._stores: dict[str, list[StoreItem]] = None
+        self._products: dict[str, list[ProductItem]] = None
+        # per market arrays, aligned with self._products[market]
+        self._unit_values: dict[str, np.ndarray] = {}
+        self._uris: dict[str, list[str]] = {}
+
+    def _init_pools(self, pool_size: int):
+        """Call Faker `pool_size` times per field, all the items are sampled from these pools"""
+        self.pool_geo_points: list[GeoPoint] = [
+            generate_geo_point(self.fake) for _ in range(pool_size)]
+        self.pool_brands: list[str] = [
+            self.fake.company() for _ in range(pool_size)]
+        self.pool_uris: list[str] = [self.fake.uri() for _ in range(pool_size)]
+        self.pool_image_urls: list[str] = [
+            self.fake.image_url() for _ in range(pool_size)]
+        self.pool_sentences: list[str] = [
+            self.fake.sentence(nb_words=3) for _ in range(pool_size)]
+        self.pool_names: list[str] = product_names if product_names else [
+            self.fake.word() for _ in range(pool_size)]
+        self.pool_variants: list[str] = product_variants if product_variants else [""]
+        self.pool_categories: list[list[str]] = [
+            [lvl3, lvl2, lvl1]
+            for lvl1, lvl2_categories in mock_data_generator.product_categories.items()
+            for lvl2, lvl3_categories in lvl2_categories.items()
+            for lvl3 in lvl3_categories
+        ] or [[self.fake.word(), self.fake.word(), self.fake.word()]]
+
+    def _sample(self, pool: list, size: int) -> list:
+        return [pool[i] for i in self.rng.integers(0, len(pool), size).tolist()]
+
+    def _random_codes(self, size: int) -> list[str]:
+        codes = self.rng.integers(0, np.iinfo(np.int64).max, size, dtype=np.int64)
+        return [f"{c:016x}" for c in codes.tolist()]
+
+    def postal_codes(self) -> list[str]:
+        return sorted({gp.postal_code for gp in self.pool_geo_points[:self.postal_codes_count]})
+
+    def stores(self) -> dict[str, list[StoreItem]]:
+        """Return the stores of every market, they are generated only on the first call"""
+        if self._stores is not None:
+            return self._stores
+
+        self._stores = {}
+        for market in self.markets:
+            store_ids = self.rng.choice(
+                100000, self.stores_per_market, replace=False).tolist()
+            services = self._sample(SERVICES, self.stores_per_market)
+            geo_points = self._sample(
+                self.pool_geo_points, self.stores_per_market)
+            market_stores = []
+            for store_id, service, geo_point in zip(store_ids, services, geo_points):
+                _id = f"{store_id}_{market}_{service}"
+                market_stores.append(StoreItem(
+                    _id=_id,
+                    store_id=store_id,
+                    name=f"{market} - {geo_point.city} - {geo_point.address}",
+                    market=market,
+                    service=service,
+                    scrape_parameters={'_id': _id, 'store_id': store_id},
+                    geo_point=geo_point,
+                ))
+            self._stores[market] = market_stores
+        return self._stores
+
+    def location_item(self) -> LocationItem:
+        return LocationItem(
+            postal_codes=self.postal_codes(),
+            markets={market: [s._id for s in stores]
+                     for market, stores in self.stores().items()}
+        )
+
+    def products(self) -> dict[str, list[ProductItem]]:
+        """Return the catalog of every market, it is generated only on the first call"""
+        if self._products is not None:
+            return self._products
+
+        self._products = {}
+        n = self.products_per_market
+        for market in self.markets:
+            codes = self._random_codes(n)
+            brands = self._sample(self.pool_brands, n)
+            names = self._sample(self.pool_names, n)
+            variants = self._sample(self.pool_variants, n)
+            unit_values = self.rng.integers(1, 1001, n)
+            unit_texts = self._sample([u[0] for u in ALL_UNITS], n)
+            image_urls = self._sample(self.pool_image_urls, n)
+            categories = self._sample(self.pool_categories, n)
+            sentences = self._sample(self.pool_sentences, n)
+            uris = self._sample(self.pool_uris, n)
+
+            self._unit_values[market] = unit_values
+            self._uris[market] = [f"{u}{c}" for u, c in zip(uris, codes)]
+            self._products[market] = [
+                ProductItem(
+                    _id=f"{code}_{market}",
+                    code=code,
+                    ean=code,
+                    description=f"{brand} - {name} {variant} - {unit_value}{unit_text}",
+                    market=market,
+                    brand=brand,
+                    unit_value=unit_value,
+                    unit_text=unit_text,
+                    image_urls=[image_url],
+                    categories=list(category),
+                    sales_denomination=sentence,
+                )
+                for code, brand, name, variant, unit_value, unit_text, image_url, category, sentence in zip(
+                    codes, brands, names, variants, unit_values.tolist(), unit_texts, image_urls, categories, sentences)
+            ]
+        return self._products
+
+    @staticmethod
+    def _draw_prices(rng: np.random.Generator, shape: tuple[int, int]) -> tuple[np.ndarray, np.ndarray]:
+        """Draw prices and discounted prices in cents"""
+        price = rng.integers(50, 3001, shape, dtype=np.int32)
+        discounted_price = 25 + (rng.random(shape) * (price - 24)).astype(np.int32)
+        return price, discounted_price
+
+    def iter_product_store_data(self, chunk_size: int = 1000) -> Iterator[tuple[datetime, str, list[ProductStoreDataItem]]]:
+        """Yield `(scrape_date, store_universal_id, items)` chunks for every scrape day, market and store
+
+        Every store sells the whole catalog of its market, every day a fraction `price_change_rate`
+        of the (store, product) prices is drawn again, the others keep the previous value.
+        The price history has its own random stream, so every call yields the same prices.
+        """
+        stores = self.stores()
+        products = self.products()
+        rng = np.random.default_rng([self.seed, 1])
+        prices = {}
+        for day in range(self.scrape_days):
+            scrape_date = self.start_date + timedelta(days=day)
+            for market in self.markets:
+                shape = (len(stores[market]), len(products[market]))
+                if day == 0:
+                    prices[market] = self._draw_prices(rng, shape)
+                else:
+                    price, discounted_price = prices[market]
+                    changed = rng.random(shape) < self.price_change_rate
+                    new_price, new_discounted_price = self._draw_prices(
+                        rng, int(changed.sum()))
+                    price[changed] = new_price
+                    discounted_price[changed] = new_discounted_price
+
+                price, discounted_price = prices[market]
+                price_eur = np.round(price / 100, 2)
+                discounted_price_eur = np.round(discounted_price / 100, 2)
+                discount_rate = np.round(
+                    (1 - discounted_price_eur / price_eur) * 100, 2)
+                label = np.round(discounted_price_eur /
+                                 (self._unit_values[market] / 1000), 2)
+                market_products = products[market]
+                uris = self._uris[market]
+
+                for store_index, store in enumerate(stores[market]):
+                    for start in range(0, len(market_products), chunk_size):
+                        end = start + chunk_size
+                        yield scrape_date, store._id, [
+                            ProductStoreDataItem(
+                                code=product.code,
+                                store_universal_id=store._id,
+                                store_id=store.store_id,
+                                market=market,
+                                price=p,
+                                discounted_price=dp,
+                                discount_rate=dr,
+                                label=lb,
+                                product_page_uri=uri,
+                                scrape_parameters={
+                                    "_id": product.code, "product_page_uri": uri},
+                                product_id=product._id
+                            )
+                            for product, p, dp, dr, lb, uri in zip(
+                                market_products[start:end],
+                                price_eur[store_index, start:end].tolist(),
+                                discounted_price_eur[store_index, start:end].tolist(),
+                                discount_rate[store_index, start:end].tolist(),
+                                label[store_index, start:end].tolist(),
+                                uris[start:end])
+                        ]
+
+    def load_to_db(self, db_interface, chunk_size: int = 1000):
+        """Stream all the generated data to the db through the `DbInterface` write methods
+
+        Every chunk of products data is stamped with its scrape date, so the loaded history matches the generated one.
+        """
+        location_item = self.location_item()
+        for market, market_stores in self.stores().items():
+            db_interface.upsert_store_items(market_stores, location_item)
+
+        for market_products in self.products().values():
+            for start in range(0, len(market_products), chunk_size):
+                db_interface.upsert_product_items(
+                    market_products[start:start + chunk_size])
+
+        for scrape_date, store_universal_id, items in self.iter_product_store_data(chunk_size):
+            db_interface.insert_temporal_products_data(
+                items, store_universal_id, last_updated=scrape_date)
+
+    def dump_to_ndjson(self, output_dir: str, chunk_size: int = 1000):
+        """Write one NDJSON file per collection in `output_dir`"""
+
+        def _dump(item: dict) -> str:
+            return json.dumps(item, default=lambda x: x.isoformat()) + "\n"
+
+        os.makedirs(output_dir, exist_ok=True)
+        with open(os.path.join(output_dir, "locations.ndjson"), "w", encoding="utf8") as f_out:
+            f_out.write(_dump(asdict(self.location_item())))
+
+        with open(os.path.join(output_dir, "stores.ndjson"), "w", encoding="utf8") as f_out:
+            for market_stores in self.stores().values():
+                f_out.writelines(_dump(asdict(s)) for s in market_stores)
+
+        with open(os.path.join(output_dir, "products.ndjson"), "w", encoding="utf8") as f_out:
+            for market_products in self.products().values():
+                f_out.writelines(_dump(asdict(p)) for p in market_products)
+
+        with open(os.path.join(output_dir, "product_store_data.ndjson"), "w", encoding="utf8") as f_out:
+            for scrape_date, _, items in self.iter_product_store_data(chunk_size):
+                for item in items:
+                    item = asdict(item)
+                    item["last_updated"] = scrape_date
+                    f_out.write(_dump(item))
+
+
+if __name__ == "__main__":
+    generator = BulkMockDataGenerator(seed=42)
+    generator.dump_to_ndjson(os.path.join(os.getcwd(), "bulk_mock_data"))
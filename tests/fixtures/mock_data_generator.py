@@ -23,20 +23,20 @@ product_variants: list[str] = []
 product_categories: dict[dict[list[str]]] = {}
 
 
-def generate_geo_point() -> GeoPoint:
+def generate_geo_point(faker: Faker = fake) -> GeoPoint:
     address: list[str] = [x.strip()
-                          for x in fake.address().replace('\n', ',').split(',')]
+                          for x in faker.address().replace('\n', ',').split(',')]
     address[1] = address[1].split(' ')[0]  # remove eventual appartment number
     # address: list[str] = [x.strip() for x in fake.address().replace('\n', ',').split(',')]
 
     return GeoPoint(
         postal_code=address[-2],
         city=address[-1].split('(')[0].strip(),
-        long=str(fake.longitude()),
-        lat=str(fake.latitude()),
+        long=str(faker.longitude()),
+        lat=str(faker.latitude()),
         address=' '.join(address[0:-2]),
         state_code=address[-1].split('(')[1].split(')')[0].strip(),
-        country_code=fake.current_country_code()
+        country_code=faker.current_country_code()
     )
 
 
@@ -0,0 +1,31 @@
+from db_interface.journal import WriteJournal
+from datetime import datetime
+
+
+def test_pending(tmp_path):
+    journal = WriteJournal(str(tmp_path / "journal.ndjson"))
+    assert journal.pending() == []
+    last_updated = datetime(2024, 1, 1, 12, 30)
+    first_id = journal.append("insert_temporal_products_data", {"items": [], "last_updated": last_updated})
+    journal.ack(journal.append("upsert_product_items", {"items": []}))
+    # a line truncated by a crash is skipped
+    with open(journal.path, "a", encoding="utf-8") as f_out:
+        f_out.write('{"batch_id": "trunc')
+
+    pending = journal.pending()
+    assert [x["batch_id"] for x in pending] == [first_id]
+    assert pending[0]["kwargs"]["last_updated"] == last_updated
+
+
+def test_compact_after_acks(tmp_path):
+    path = tmp_path / "journal.ndjson"
+    journal = WriteJournal(str(path), compact_every=3)
+    pending_id = journal.append("upsert_product_items", {"items": []})
+    for i in range(2):
+        journal.ack(journal.append("upsert_product_items", {"items": [i]}))
+    assert len(path.read_text().splitlines()) == 5
+
+    # the third acknowledgement rewrites the file with only the pending batches
+    journal.ack(journal.append("upsert_product_items", {"items": [2]}))
+    assert len(path.read_text().splitlines()) == 1
+    assert [x["batch_id"] for x in journal.pending()] == [pending_id]
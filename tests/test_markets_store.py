@@ -0,0 +1,46 @@
+from db_interface.markets_store import MarketsStore
+from datetime import datetime
+import time
+
+
+def _wait_for(condition, timeout: float = 5):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if condition():
+            return True
+        time.sleep(0.05)
+    return False
+
+
+def test_load_and_get(mongo_db):
+    collection = mongo_db["markets"]
+    collection.insert_many([
+        {"name_lower": "crai", "name": "Crai", "last_updated": datetime.utcnow()},
+        {"name_lower": "lidl", "name": "Lidl", "last_updated": datetime.utcnow()},
+    ])
+    store = MarketsStore(collection, use_change_stream=False)
+
+    assert sorted(x["name_lower"] for x in store.get()) == ["crai", "lidl"]
+    assert [x["name"] for x in store.get(["lidl", "pam"])] == ["Lidl"]
+    # the markets returned are copies
+    store.get(["crai"])[0]["name"] = "changed"
+    assert store.get(["crai"])[0]["name"] == "Crai"
+
+
+def test_polling(mongo_db):
+    collection = mongo_db["markets"]
+    collection.insert_one({"name_lower": "crai", "name": "Crai", "last_updated": datetime.utcnow()})
+    store = MarketsStore(collection, poll_interval=0.1, use_change_stream=False)
+    store.start()
+    try:
+        collection.insert_one({"name_lower": "lidl", "name": "Lidl", "last_updated": datetime.utcnow()})
+        assert _wait_for(lambda: len(store.get()) == 2)
+
+        # an update without new markets moves the watermark through `last_updated`
+        collection.update_one({"name_lower": "crai"}, {"$set": {"name": "CRAI", "last_updated": datetime.utcnow()}})
+        assert _wait_for(lambda: store.get(["crai"])[0]["name"] == "CRAI")
+
+        collection.delete_one({"name_lower": "lidl"})
+        assert _wait_for(lambda: len(store.get()) == 1)
+    finally:
+        store.stop()
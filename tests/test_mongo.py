@@ -1,10 +1,17 @@
 from fixtures.mock_data_generator import generate_geo_point, generate_store_item, generate_product_item, generate_product_store_data_item
 from db_interface import DbInterface
 # from algolia_handler import load_to_algolia
-from db_interface.items import GeoPoint, LocationItem, ProductItem, StoreItem, ProductStoreDataItem
+from db_interface.items import GeoPoint, LocationItem, ProductItem, StoreItem, ProductStoreDataItem, compute_location_ids
+from db_interface.read_settings import SERVING, ANALYTICS, SERVING_READ_SETTINGS, ANALYTICS_READ_SETTINGS
+from db_interface.batch import ProductStoreDataBatch
 import sys
 import os
 import json
+import pytest
+import pymongo
+from pymongo import InsertOne, monitoring
+from dataclasses import asdict, replace
+from datetime import datetime, timedelta
 sys.path.append(os.getcwd())
 
 POSTAL_CODES_COUNT = 5
@@ -158,3 +165,491 @@ def test_load_to_db(mongo_db):
 #         db_products = [p for p in it_products]
 #
 #     load_to_algolia(db_products)
+
+
+@pytest.fixture
+def store_items(mongo_db):
+    """A store of the postal code 00100 and ten products data scraped from it"""
+    store = generate_store_item("crai")
+    DbInterface(db_connection=mongo_db, is_mock=True).upsert_store_items([store], LocationItem(postal_codes=["00100"]))
+    items = [generate_product_store_data_item(
+        store._id, store.store_id, store.market) for _ in range(10)]
+    return store, items
+
+
+def test_upsert_product_items_skip_unchanged(mongo_db):
+    db = DbInterface(db_connection=mongo_db, is_mock=True)
+    product_items = [generate_product_item("crai") for _ in range(20)]
+
+    counts = db.upsert_product_items(product_items, skip_unchanged=True)
+    assert counts == {"inserted": 20, "changed": 0, "skipped": 0}
+
+    product_items[0].brand = "changed"
+    counts = db.upsert_product_items(product_items, skip_unchanged=True)
+    assert counts == {"inserted": 0, "changed": 1, "skipped": 19}
+
+    # a new instance has an empty cache and reads the hashes from the db
+    db = DbInterface(db_connection=mongo_db, is_mock=True)
+    counts = db.upsert_product_items(product_items, skip_unchanged=True)
+    assert counts == {"inserted": 0, "changed": 0, "skipped": 20}
+
+
+def test_insert_temporal_products_data_only_changed(mongo_db, store_items):
+    db = DbInterface(db_connection=mongo_db, is_mock=True)
+    store, items = store_items
+    product_ids = [x.product_id for x in items]
+
+    assert db.insert_temporal_products_data(items, store._id, only_changed=True, last_updated=datetime(2024, 1, 1)) == 10
+    items[0].price += 1
+    assert db.insert_temporal_products_data(items, store._id, only_changed=True, last_updated=datetime(2024, 1, 2)) == 1
+
+    prices = db.get_prices(product_ids, store._id)
+    assert len(prices) == 10
+    for item in items:
+        assert prices[item.product_id]["price"] == item.price
+
+
+def test_insert_temporal_products_data_only_changed_split_scrape(mongo_db, store_items):
+    db = DbInterface(db_connection=mongo_db, is_mock=True)
+    store, items = store_items
+    product_ids = [x.product_id for x in items]
+    db.insert_temporal_products_data(items, store._id, only_changed=True, last_updated=datetime(2024, 1, 1))
+
+    # the next scrape is split in two calls, all the products are unchanged
+    last_updated = datetime(2024, 1, 2)
+    assert db.insert_temporal_products_data(items[:2], store._id, only_changed=True, last_updated=last_updated) == 0
+    assert db.insert_temporal_products_data(items[2:], store._id, only_changed=True, last_updated=last_updated) == 0
+
+    prices = db.get_prices(product_ids, store._id)
+    assert sorted(prices.keys()) == sorted(product_ids)
+
+
+def test_get_products_to_scrape_only_changed(mongo_db, store_items):
+    db = DbInterface(db_connection=mongo_db, is_mock=True)
+    store, items = store_items
+    db.insert_temporal_products_data(items, store._id, only_changed=True, last_updated=datetime(2024, 1, 1))
+    items[0].price += 1
+    db.insert_temporal_products_data(items, store._id, only_changed=True, last_updated=datetime(2024, 1, 3))
+
+    # the unchanged products of the last scrape have no observation since the 2nd
+    scrape_parameters = db.get_products_to_scrape("crai", datetime(2024, 1, 2))
+    assert sorted(scrape_parameters, key=json.dumps) == sorted([x.scrape_parameters for x in items], key=json.dumps)
+
+
+def test_insert_temporal_products_data_failed_write(mongo_db, monkeypatch, store_items):
+    db = DbInterface(db_connection=mongo_db, is_mock=True)
+    store, items = store_items
+    db.insert_temporal_products_data(items, store._id, only_changed=True, last_updated=datetime(2024, 1, 1))
+
+    items[0].price += 1
+
+    def _fail(*args, **kwargs):
+        raise pymongo.errors.AutoReconnect("connection lost")
+    with monkeypatch.context() as m:
+        m.setattr(db, "_bulk_write", _fail)
+        with pytest.raises(pymongo.errors.AutoReconnect):
+            db.insert_temporal_products_data(items, store._id, only_changed=True, last_updated=datetime(2024, 1, 2))
+    # the price that was never written is not cached as written
+    assert db.insert_temporal_products_data(items, store._id, only_changed=True, last_updated=datetime(2024, 1, 2)) == 1
+
+
+def test_upsert_store_items_batch(mongo_db):
+    db = DbInterface(db_connection=mongo_db, is_mock=True)
+    crai_stores = [generate_store_item("crai") for _ in range(3)]
+    lidl_stores = [generate_store_item("lidl") for _ in range(3)]
+    location_a = LocationItem(postal_codes=["00100", "00118"])
+    location_b = LocationItem(postal_codes=["20121"])
+
+    db.upsert_store_items_batch([
+        (location_a, crai_stores + lidl_stores[:1]),
+        (location_b, lidl_stores),
+        (location_a, crai_stores[:1]),
+    ])
+
+    locations = {tuple(l["postal_codes"]): l["markets"]
+                 for l in db.db[db.COLLECTION_NAME_LOCATIONS].find()}
+    assert locations[tuple(location_a.postal_codes)] == {
+        "crai": [s._id for s in crai_stores], "lidl": [lidl_stores[0]._id]}
+    assert locations[tuple(location_b.postal_codes)] == {
+        "lidl": [s._id for s in lidl_stores]}
+    assert db.db[db.COLLECTION_NAME_STORES].count_documents({}) == 6
+
+    # the same location with the postal codes in another order
+    db.upsert_store_items_batch([(LocationItem(postal_codes=["00118", "00100"]), lidl_stores[1:2])])
+    location = db.db[db.COLLECTION_NAME_LOCATIONS].find_one(
+        {"location_id": compute_location_ids([location_a.postal_codes])[0]})
+    assert location["markets"]["lidl"] == [lidl_stores[1]._id]
+    assert db.db[db.COLLECTION_NAME_LOCATIONS].count_documents({}) == 2
+
+
+def test_locations_written_before_location_id(mongo_db):
+    db = DbInterface(db_connection=mongo_db, db_connection_misc=mongo_db, is_mock=True)
+    stores = [generate_store_item("crai") for _ in range(3)] + [generate_store_item("lidl")]
+    for store in stores:
+        store.geo_point.lat, store.geo_point.long = float(store.geo_point.lat), float(store.geo_point.long)
+    db.db[db.COLLECTION_NAME_STORES].insert_many([asdict(x) for x in stores])
+    # two documents of the same location written before `location_id` was stored and indexed, the postal codes in
+    # different order
+    collection = db.db[db.COLLECTION_NAME_LOCATIONS]
+    collection.insert_many([
+        {"postal_codes": ["00100", "00118"], "markets": {"crai": [stores[0]._id]},
+         "last_updated": datetime(2024, 1, 1)},
+        {"postal_codes": ["00118", "00100"], "markets": {"crai": [stores[1]._id], "lidl": [stores[3]._id]},
+         "last_updated": datetime(2024, 1, 2)},
+    ])
+
+    # the stale duplicate is not merged, neither from the db nor from the postal code index
+    db_index = DbInterface(db_connection=mongo_db, db_connection_misc=mongo_db, is_mock=True, preload_postal_index=True)
+    for db_markets in (db, db_index):
+        markets = db_markets.get_available_markets("00100", 45.46, 9.19)
+        assert {market: [x["_id"] for x in data["stores"]] for market, data in markets.items()} == {
+            "crai": [stores[1]._id], "lidl": [stores[3]._id]}
+    assert db.rebuild_cheapest_offers() == 0
+
+    # the location with the postal codes sorted is found by them
+    db.upsert_store_items([stores[2]], LocationItem(postal_codes=["00118", "00100"]))
+    assert collection.count_documents({}) == 2
+    location_id = compute_location_ids([["00100", "00118"]])[0]
+    assert collection.find_one({"location_id": location_id})["markets"] == {"crai": [stores[2]._id]}
+
+    # the backfill merges the documents of the same location
+    assert db.backfill_location_ids() == 1
+    locations = list(collection.find())
+    assert len(locations) == 1
+    assert locations[0]["location_id"] == location_id
+    assert locations[0]["postal_codes"] == ["00100", "00118"]
+    assert locations[0]["markets"] == {"crai": [stores[2]._id], "lidl": [stores[3]._id]}
+
+
+class _ReadsListener(monitoring.CommandListener):
+    """Record the read commands sent by a client with the read preference selected for them"""
+
+    def __init__(self):
+        self.reads: list[tuple[dict, dict]] = []
+        self.read_preference = None
+
+    def started(self, event):
+        if event.command_name in ("find", "aggregate", "distinct"):
+            self.reads.append((event.command, self.read_preference))
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+
+def test_read_settings(mongo_db, monkeypatch, store_items):
+    listener = _ReadsListener()
+    client = pymongo.MongoClient(**mongo_db.pmr_credentials.as_mongo_kwargs(), event_listeners=[listener])
+    # pymongo doesn't send $readPreference to a standalone server, so the preference given to the driver is recorded too
+    socket_from_server = client._socket_from_server
+
+    def _socket_from_server(read_preference, server, session):
+        listener.read_preference = read_preference.document
+        return socket_from_server(read_preference, server, session)
+    monkeypatch.setattr(client, "_socket_from_server", _socket_from_server)
+
+    db = DbInterface(db_connection=client[mongo_db.name], is_mock=True,
+                     read_settings={SERVING: SERVING_READ_SETTINGS, ANALYTICS: ANALYTICS_READ_SETTINGS})
+    store, items = store_items
+    db.insert_temporal_products_data(items, store._id)
+
+    listener.reads = []
+    # on a standalone server the secondary preferred reads fall back to the primary
+    assert sorted(db.get_store_products_ids(store._id)) == sorted(x.product_id for x in items)
+    assert len(db.get_products_data_by_store(store._id)) == 10
+    # the last rolled up day and the observations
+    assert len(list(db.get_price_history([items[0].product_id], [store._id], datetime(2024, 1, 1), datetime.utcnow()))) == 1
+    assert len(listener.reads) == 4
+    standalone = client.topology_description.topology_type_name == "Single"
+    for command, read_preference in listener.reads:
+        assert command["maxTimeMS"] == ANALYTICS_READ_SETTINGS.max_time_ms
+        assert command["readConcern"] == ANALYTICS_READ_SETTINGS.read_concern.document
+        assert read_preference == ANALYTICS_READ_SETTINGS.read_preference.document
+        if not standalone:
+            assert command["$readPreference"] == ANALYTICS_READ_SETTINGS.read_preference.document
+
+    listener.reads = []
+    assert len(db.get_prices([x.product_id for x in items], store._id)) == 10
+    assert db.get_cheapest_offers("00100") == {}
+    assert {next(iter(command)) for command, _ in listener.reads} == {"aggregate", "find"}
+    for command, read_preference in listener.reads:
+        assert command["maxTimeMS"] == SERVING_READ_SETTINGS.max_time_ms
+        assert "$readPreference" not in command
+        assert read_preference == SERVING_READ_SETTINGS.read_preference.document
+    client.close()
+
+
+def test_insert_temporal_products_data_idempotent(mongo_db, tmp_path, store_items):
+    db = DbInterface(db_connection=mongo_db, is_mock=True, journal_path=str(tmp_path / "journal.ndjson"))
+    store, items = store_items
+    last_updated = datetime(2024, 1, 1)
+
+    db.insert_temporal_products_data(items[:7], store._id, last_updated=last_updated)
+    assert db.journal.pending() == []
+    # a batch spilled by a worker that crashed before the acknowledgement, after writing part of it
+    db.journal.append("insert_temporal_products_data", {
+        "items": [asdict(x) for x in items], "store_universal_id": store._id, "last_updated": last_updated})
+    assert db.resume_journal() == 1
+    assert db.journal.pending() == []
+
+    ids = [x["_id"] for x in db.db[db.COLLECTION_NAME_PRODUCT_STORES_DATA].find({}, {"_id": 1})]
+    assert len(ids) == len(set(ids)) == 10
+
+
+def test_resume_journal_after_newer_scrape(mongo_db, tmp_path, store_items):
+    db = DbInterface(db_connection=mongo_db, is_mock=True, journal_path=str(tmp_path / "journal.ndjson"))
+    store, items = store_items
+    db.insert_temporal_products_data(items, store._id, last_updated=datetime(2024, 1, 1))
+    # the batch of the scrape of the 2nd is spilled by a worker that crashed, then the store is scraped again
+    db.journal.append("insert_temporal_products_data", {
+        "items": [asdict(x) for x in items], "store_universal_id": store._id, "last_updated": datetime(2024, 1, 2)})
+    items[0].price += 1
+    assert db.insert_temporal_products_data(items, store._id, only_changed=True, last_updated=datetime(2024, 1, 3)) == 1
+
+    assert db.resume_journal() == 1
+    stored = db.db[db.COLLECTION_NAME_STORES].find_one({"_id": store._id})
+    assert stored["last_scraped"] == datetime(2024, 1, 3)
+    assert sorted(stored["unchanged_product_ids"]) == sorted(x.product_id for x in items[1:])
+    prices = db.get_prices([x.product_id for x in items], store._id)
+    assert {k: v["price"] for k, v in prices.items()} == {x.product_id: x.price for x in items}
+
+
+def test_bulk_write_connection_lost(mongo_db, monkeypatch):
+    db = DbInterface(db_connection=mongo_db, is_mock=True)
+    db.WRITE_RETRY_BACKOFF = 0
+    collection = db.db[db.COLLECTION_NAME_PRODUCT_STORES_DATA]
+    bulk_write = type(collection).bulk_write
+    attempts = []
+
+    def _bulk_write(self, requests, *args, **kwargs):
+        attempts.append(len(requests))
+        if len(attempts) == 1:
+            # the connection is lost after part of the batch was written
+            bulk_write(self, requests[:2], *args, **kwargs)
+            raise pymongo.errors.AutoReconnect("connection lost")
+        return bulk_write(self, requests, *args, **kwargs)
+    monkeypatch.setattr(type(collection), "bulk_write", _bulk_write)
+
+    counts = db._bulk_write(collection, [InsertOne({"_id": str(i), "price": i}) for i in range(5)])
+    # only the documents not stored by the first attempt are resubmitted
+    assert attempts == [5, 3]
+    assert counts["nInserted"] == 5
+    assert collection.count_documents({}) == 5
+
+
+def test_insert_temporal_products_data_batch(mongo_db, store_items):
+    db = DbInterface(db_connection=mongo_db, is_mock=True)
+    store, items = store_items
+    items[0].discounted_price = None
+    batch = ProductStoreDataBatch.from_items(items[:9])
+    price = batch.price
+    # the batch still grows after its prices are read
+    batch.append(items[9])
+    assert len(price) == 9
+    assert len(batch) == 10
+    assert batch.price.tolist() == [x.price for x in items]
+
+    assert db.insert_temporal_products_data(batch, store._id, only_changed=True, last_updated=datetime(2024, 1, 1)) == 10
+    assert db.insert_temporal_products_data(batch, store._id, only_changed=True, last_updated=datetime(2024, 1, 2)) == 0
+
+    prices = db.get_prices([x.product_id for x in items], store._id)
+    for item in items:
+        assert prices[item.product_id]["price"] == item.price
+        assert prices[item.product_id]["discounted_price"] == item.discounted_price
+
+
+def test_cheapest_offers(mongo_db):
+    db = DbInterface(db_connection=mongo_db, is_mock=True)
+    stores = [generate_store_item("crai") for _ in range(3)]
+    # the postal code 00100 belongs to both locations
+    db.upsert_store_items(stores[:2], LocationItem(postal_codes=["00100", "00118"]))
+    db.upsert_store_items(stores[1:], LocationItem(postal_codes=["00100"]))
+    item = generate_product_store_data_item(stores[0]._id, stores[0].store_id, "crai")
+    for store, price in zip(stores, (3.0, 2.0, 1.0)):
+        db.insert_temporal_products_data([replace(item, store_universal_id=store._id, store_id=store.store_id,
+                                                  price=price, discounted_price=None)], store._id,
+                                         last_updated=datetime(2024, 1, 1))
+
+    assert db.rebuild_cheapest_offers(locations_chunk_size=1) == 2
+    offers = db.get_cheapest_offers("00118")[item.product_id]
+    assert [x["store_universal_id"] for x in offers] == [stores[1]._id, stores[0]._id]
+    offers = db.get_cheapest_offers("00100", top_n=2)[item.product_id]
+    assert [x["store_universal_id"] for x in offers] == [stores[2]._id, stores[1]._id]
+    offers = db.get_cheapest_offers("00100", product_ids=[item.product_id])[item.product_id]
+    assert [x["price"] for x in offers] == [1.0, 2.0, 3.0]
+
+    # incremental merge of a new scrape
+    db.insert_temporal_products_data([replace(item, price=0.5, discounted_price=None)], stores[0]._id,
+                                     update_cheapest=True, last_updated=datetime(2024, 1, 2))
+    offers = db.get_cheapest_offers("00118")[item.product_id]
+    assert [(x["store_universal_id"], x["price"]) for x in offers] == [(stores[0]._id, 0.5), (stores[1]._id, 2.0)]
+    offers = db.get_cheapest_offers("00100")[item.product_id]
+    assert [x["price"] for x in offers] == [0.5, 1.0, 2.0]
+    assert db.get_cheapest_offers("20121") == {}
+
+
+def test_cheapest_offers_merged_during_rebuild(mongo_db, monkeypatch, store_items):
+    db = DbInterface(db_connection=mongo_db, is_mock=True)
+    store, items = store_items
+    db.insert_temporal_products_data(items[:1], store._id, last_updated=datetime(2024, 1, 1))
+
+    # a scrape of the day before is merged while the rebuild reads the offers
+    get_stores_current_offers = db._get_stores_current_offers
+
+    def merge_scrape(store_ids):
+        db.update_cheapest_offers(items[1:], store._id, last_updated=datetime(2024, 1, 1))
+        return get_stores_current_offers(store_ids)
+    monkeypatch.setattr(db, "_get_stores_current_offers", merge_scrape)
+
+    db.rebuild_cheapest_offers()
+    assert sorted(db.get_cheapest_offers("00100").keys()) == sorted(x.product_id for x in items)
+
+
+def test_export_columnar(mongo_db, tmp_path, store_items):
+    pq = pytest.importorskip("pyarrow.parquet")
+    db = DbInterface(db_connection=mongo_db, is_mock=True)
+    products = [generate_product_item("crai") for _ in range(5)] + [generate_product_item("lidl")]
+    db.upsert_product_items(products)
+    store, items = store_items
+    db.insert_temporal_products_data(items, store._id, last_updated=datetime(2024, 1, 1))
+    db.insert_temporal_products_data(items[:2], store._id, last_updated=datetime(2024, 1, 2))
+
+    # the batches are smaller than the results
+    frame = db.export_market_products("crai", batch_size=2)
+    assert sorted(frame["_id"]) == sorted(x._id for x in products[:5])
+    product = frame.set_index("_id").loc[products[0]._id]
+    assert product["description"] == products[0].description
+    assert list(product["categories"]) == products[0].categories
+    assert db.export_market_products("crai", path=str(tmp_path / "products.parquet"), batch_size=2) == 5
+    assert pq.read_table(tmp_path / "products.parquet").to_pandas().equals(frame)
+
+    frame = db.export_product_store_data("crai", start=datetime(2024, 1, 1), end=datetime(2024, 1, 2), batch_size=2)
+    assert sorted(frame["product_id"]) == sorted(x.product_id for x in items)
+    assert sorted(frame["price"]) == sorted(x.price for x in items)
+    assert set(frame["last_updated"]) == {datetime(2024, 1, 1)}
+    assert "scrape_parameters" not in frame.columns
+    assert len(db.export_product_store_data("crai", start=datetime(2024, 1, 1))) == 12
+    assert db.export_product_store_data(
+        "crai", end=datetime(2024, 1, 2), path=str(tmp_path / "prices.parquet"), batch_size=2) == 10
+    assert pq.read_table(tmp_path / "prices.parquet").to_pandas().equals(frame)
+
+
+def _insert_daily_observations(db: DbInterface, days: int):
+    """Insert the observations of a product at 8:00 and at 20:00 of each of the last `days` days"""
+    store = generate_store_item("crai")
+    db.upsert_store_items([store], LocationItem(postal_codes=["00100"]))
+    item = generate_product_store_data_item(store._id, store.store_id, store.market)
+    today = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
+    for day in range(days, 0, -1):
+        for hour, price in ((8, 2.0), (20, 1.0)):
+            db.insert_temporal_products_data([replace(item, price=price + day, label=f"label {day}")], store._id,
+                                             last_updated=today - timedelta(days=day, hours=-hour))
+    return store, item, today
+
+
+def test_rollup_daily_prices(mongo_db):
+    db = DbInterface(db_connection=mongo_db, is_mock=True)
+    store, item, today = _insert_daily_observations(db, 4)
+    daily = db.db[db.COLLECTION_NAME_PRODUCT_STORES_DATA_DAILY]
+
+    assert db.rollup_daily_prices(older_than_days=2) == today - timedelta(days=2)
+    days = list(daily.find({}, {"_id": 0}).sort("date", 1))
+    assert [x["date"] for x in days] == [today - timedelta(days=4), today - timedelta(days=3)]
+    for day, doc in zip((4, 3), days):
+        assert (doc["open_price"], doc["min_price"], doc["max_price"], doc["close_price"]) == (
+            2.0 + day, 1.0 + day, 2.0 + day, 1.0 + day)
+        assert doc["close_label"] == f"label {day}"
+        assert doc["observations"] == 2
+
+    # running it again on the same days replaces the daily documents
+    db.rollup_daily_prices(older_than_days=2, since=today - timedelta(days=10))
+    assert list(daily.find({}, {"_id": 0}).sort("date", 1)) == days
+    # the next run starts from the last rolled up day
+    db.rollup_daily_prices(older_than_days=1)
+    assert daily.count_documents({}) == 3
+
+
+def test_get_price_history_tiers(mongo_db):
+    db = DbInterface(db_connection=mongo_db, is_mock=True)
+    store, item, today = _insert_daily_observations(db, 4)
+    db.rollup_daily_prices(older_than_days=2)
+    # the raw observations of the oldest day expired
+    db.db[db.COLLECTION_NAME_PRODUCT_STORES_DATA].delete_many({"last_updated": {"$lt": today - timedelta(days=3)}})
+
+    history = list(db.get_price_history([item.product_id], [store._id], today - timedelta(days=10), today))
+    assert [x["date"] for x in history] == [today - timedelta(days=day) for day in (4, 3, 2, 1)]
+    for day, point in zip((4, 3, 2, 1), history):
+        assert (point["min_price"], point["max_price"], point["last_price"]) == (1.0 + day, 2.0 + day, 1.0 + day)
+
+    # the rolled up days have a single point even with a finer resolution
+    history = list(db.get_price_history([item.product_id], [store._id], today - timedelta(days=10), today,
+                                        resolution="hour"))
+    assert len(history) == 2 + 2 * 2
+
+
+@pytest.mark.parametrize("resolution", ["week", "month"])
+def test_get_price_history_tier_boundary(mongo_db, resolution):
+    db = DbInterface(db_connection=mongo_db, is_mock=True)
+    store, item, today = _insert_daily_observations(db, 4)
+    db.rollup_daily_prices(older_than_days=2)
+
+    def _bucket(date):
+        if resolution == "week":
+            # the weeks of $dateTrunc start on Sunday
+            return date - timedelta(days=(date.weekday() + 1) % 7)
+        return date.replace(day=1)
+    expected = {}
+    for day in (4, 3, 2, 1):
+        point = expected.setdefault(_bucket(today - timedelta(days=day)), {"min_price": 1.0 + day, "max_price": 2.0 + day})
+        point["min_price"] = min(point["min_price"], 1.0 + day)
+        point["max_price"] = max(point["max_price"], 2.0 + day)
+        point["last_price"] = 1.0 + day
+
+    # `start` in the middle of the first rolled up day, that day is read whole
+    history = list(db.get_price_history([item.product_id], [store._id], today - timedelta(days=4, hours=-12), today,
+                                        resolution=resolution))
+    assert len(history) == len(expected)
+    assert {x["date"]: {k: x[k] for k in ("min_price", "max_price", "last_price")} for x in history} == expected
+
+
+def test_last_observation_after_retention(mongo_db):
+    db = DbInterface(db_connection=mongo_db, is_mock=True)
+    store, item, today = _insert_daily_observations(db, 3)
+    db.rollup_daily_prices(older_than_days=0)
+    # every raw observation expired
+    db.db[db.COLLECTION_NAME_PRODUCT_STORES_DATA].delete_many({})
+
+    # a new instance doesn't have the last prices in memory
+    db = DbInterface(db_connection=mongo_db, is_mock=True)
+    unchanged = replace(item, price=2.0, label="label 1")
+    assert db.insert_temporal_products_data([unchanged], store._id, only_changed=True) == 0
+    prices = db.get_prices([item.product_id], store._id)
+    assert prices[item.product_id]["price"] == 2.0
+    assert prices[item.product_id]["label"] == "label 1"
+
+
+@pytest.mark.parametrize("code, attempts", [(16500, 2), (121, 1)])
+def test_bulk_write_errors(mongo_db, monkeypatch, code, attempts):
+    db = DbInterface(db_connection=mongo_db, is_mock=True)
+    db.WRITE_RETRY_BACKOFF = 0
+    collection = db.db[db.COLLECTION_NAME_PRODUCT_STORES_DATA]
+    bulk_write = type(collection).bulk_write
+    calls = []
+
+    def _bulk_write(self, requests, *args, **kwargs):
+        calls.append(len(requests))
+        if len(calls) == 1:
+            raise pymongo.errors.BulkWriteError({"writeErrors": [{"index": 0, "code": code, "errmsg": "failed"}]})
+        return bulk_write(self, requests, *args, **kwargs)
+    monkeypatch.setattr(type(collection), "bulk_write", _bulk_write)
+
+    requests = [InsertOne({"_id": "0", "price": 1.0})]
+    if attempts == 1:
+        # a document validation error is not transient
+        with pytest.raises(pymongo.errors.BulkWriteError):
+            db._bulk_write(collection, requests)
+    else:
+        db._bulk_write(collection, requests)
+    assert len(calls) == attempts
@@ -0,0 +1,87 @@
+from fixtures.mock_data_generator import generate_store_item, generate_product_store_data_item
+from db_interface import DbInterface
+from db_interface import pipelines
+from db_interface.pipelines import DbInterfacePipeline
+from twisted.internet import defer
+import pytest
+
+POSTAL_CODES = ["00118", "00100"]
+
+
+class Spider:
+    def __init__(self, input_params: dict):
+        self.input_params = input_params
+
+
+@pytest.fixture
+def pipeline(mongo_db, monkeypatch):
+    # the writes run synchronously instead of in the reactor thread pool
+    monkeypatch.setattr(pipelines.threads, "deferToThread",
+                        lambda f, *args, **kwargs: defer.maybeDeferred(f, *args, **kwargs))
+    pipeline = DbInterfacePipeline(batch_size=2)
+    pipeline.db = DbInterface(db_connection=mongo_db, is_mock=True)
+    # closed by the test
+    pipeline.db.close = lambda: None
+    return pipeline
+
+
+def test_stores_in_many_batches(pipeline):
+    spider = Spider({"postal_codes": POSTAL_CODES})
+    pipeline.input_params = spider.input_params
+    crai_stores = [generate_store_item("crai") for _ in range(5)]
+    lidl_stores = [generate_store_item("lidl") for _ in range(2)]
+    for store in crai_stores + lidl_stores:
+        store._id = None
+        pipeline.process_item(store, spider)
+    pipeline.close_spider(spider)
+
+    db = pipeline.db
+    assert db.db[db.COLLECTION_NAME_STORES].count_documents({}) == 7
+    locations = list(db.db[db.COLLECTION_NAME_LOCATIONS].find())
+    assert len(locations) == 1
+    assert locations[0]["postal_codes"] == sorted(POSTAL_CODES)
+    assert locations[0]["markets"] == {
+        "crai": [f"{x.store_id}_crai_{x.service}" for x in crai_stores],
+        "lidl": [f"{x.store_id}_lidl_{x.service}" for x in lidl_stores]}
+
+
+def test_products_data(pipeline):
+    store = generate_store_item("crai")
+    spider = Spider({"postal_codes": POSTAL_CODES, "_id": store._id, "store_id": store.store_id})
+    pipeline.input_params = spider.input_params
+    pipeline.process_item(store, spider)
+    items = [generate_product_store_data_item(None, None, "crai") for _ in range(5)]
+    for item in items:
+        item.product_id = None
+        pipeline.process_item(item, spider)
+    pipeline.close_spider(spider)
+
+    # the products data of the store written in many batches share the scrape time
+    prices = pipeline.db.get_prices([f"{x.code}_crai" for x in items], store._id)
+    assert sorted(prices.keys()) == sorted(f"{x.code}_crai" for x in items)
+
+
+def test_missing_input_params(pipeline):
+    spider = Spider({})
+    pipeline.input_params = spider.input_params
+    with pytest.raises(ValueError):
+        pipeline.process_item(generate_store_item("crai"), spider)
+    with pytest.raises(ValueError):
+        pipeline.process_item(generate_product_store_data_item(None, None, "crai"), spider)
+
+
+def test_backpressure(pipeline):
+    pipeline.max_pending_writes = 1
+    spider = Spider({"postal_codes": POSTAL_CODES})
+    pipeline.input_params = spider.input_params
+    pending = defer.Deferred()
+    pipeline._track(pending)
+
+    results = []
+    d = pipeline.process_item(generate_store_item("crai"), spider)
+    assert isinstance(d, defer.Deferred)
+    d.addCallback(results.append)
+    assert results == []
+    pending.callback(None)
+    assert len(results) == 1
+    assert pipeline.process_item(generate_store_item("crai"), spider) is not None
@@ -0,0 +1,85 @@
+from fixtures.mock_data_generator import generate_store_item
+from db_interface import DbInterface
+from db_interface.items import LocationItem
+from db_interface.postal_index import PostalCodeIndex
+import pytest
+
+LAT, LON = 45.46, 9.19
+
+
+def _generate_stores(market: str, count: int):
+    stores = [generate_store_item(market) for _ in range(count)]
+    for store in stores:
+        store.geo_point.lat, store.geo_point.long = float(store.geo_point.lat), float(store.geo_point.long)
+    return stores
+
+
+def _load(db: DbInterface):
+    crai_stores = _generate_stores("crai", 4)
+    lidl_stores = _generate_stores("lidl", 2)
+    db.upsert_store_items(crai_stores[:3], LocationItem(postal_codes=["00100", "00118"]))
+    db.upsert_store_items(crai_stores[2:], LocationItem(postal_codes=["00100"]))
+    db.upsert_store_items(lidl_stores, LocationItem(postal_codes=["20121"]))
+    return crai_stores, lidl_stores
+
+
+def _assert_same_markets(markets_index: dict, markets_db: dict):
+    assert sorted(markets_index.keys()) == sorted(markets_db.keys())
+    for market, market_data in markets_db.items():
+        stores_index = markets_index[market]["stores"]
+        assert [x["_id"] for x in stores_index] == [x["_id"] for x in market_data["stores"]]
+        assert [x["distance"] for x in stores_index] == pytest.approx([x["distance"] for x in market_data["stores"]])
+        for store_index, store_db in zip(stores_index, market_data["stores"]):
+            for field in ("market", "name", "service"):
+                assert store_index[field] == store_db[field]
+        assert markets_index[market]["meta"] == market_data["meta"]
+
+
+def test_build_lookup(mongo_db):
+    db = DbInterface(db_connection=mongo_db, db_connection_misc=mongo_db, is_mock=True)
+    db.misc_db[db.COLLECTION_NAME_MARKETS].insert_one({"name_lower": "crai", "name": "Crai"})
+    _load(db)
+    db_index = DbInterface(db_connection=mongo_db, db_connection_misc=mongo_db, is_mock=True, preload_postal_index=True)
+
+    for postal_code in ("00100", "00118", "20121", "99999"):
+        _assert_same_markets(db_index.get_available_markets(postal_code, LAT, LON),
+                             db.get_available_markets(postal_code, LAT, LON))
+
+
+def test_incremental_update(mongo_db):
+    db = DbInterface(db_connection=mongo_db, db_connection_misc=mongo_db, is_mock=True)
+    db_index = DbInterface(db_connection=mongo_db, db_connection_misc=mongo_db, is_mock=True, preload_postal_index=True)
+    assert db_index.get_available_markets("00100", LAT, LON) == {}
+
+    # the stores are written through the instance with the index
+    crai_stores, _ = _load(db_index)
+    for postal_code in ("00100", "00118", "20121"):
+        _assert_same_markets(db_index.get_available_markets(postal_code, LAT, LON),
+                             db.get_available_markets(postal_code, LAT, LON))
+
+    # a new scrape of a location replaces its stores
+    db_index.upsert_store_items(crai_stores[:1], LocationItem(postal_codes=["00100", "00118"]))
+    _assert_same_markets(db_index.get_available_markets("00118", LAT, LON),
+                         db.get_available_markets("00118", LAT, LON))
+    assert [x["_id"] for x in db_index.get_available_markets("00118", LAT, LON)["crai"]["stores"]] == [crai_stores[0]._id]
+
+
+def test_set_location():
+    index = PostalCodeIndex()
+    index.add_stores([
+        {"_id": "a", "market": "crai", "name": "A", "service": "pickup", "geo_point": {"lat": 45.0, "long": 9.0}},
+        {"_id": "b", "market": "crai", "name": "B", "service": "delivery", "geo_point": None},
+    ])
+    index.set_location(["00100", "00118"], "crai", ["a", "b", "unknown"])
+    assert [x["_id"] for x in index.lookup("00118", 45.0, 9.0)["crai"]] == ["a", "b"]
+    assert index.lookup("00118", 45.0, 9.0)["crai"][1]["distance"] == 9999
+
+    # the same location with the postal codes in another order replaces the stores of the market
+    index.set_location(["00118", "00100"], "crai", ["b"])
+    assert [x["_id"] for x in index.lookup("00100", 45.0, 9.0)["crai"]] == ["b"]
+
+    # updated stores keep their position in the arrays
+    index.add_stores([{"_id": "b", "market": "crai", "name": "B2", "service": "pickup", "geo_point": {"lat": 45.0, "long": 9.0}}])
+    store = index.lookup("00100", 45.0, 9.0)["crai"][0]
+    assert (store["name"], store["service"], store["distance"]) == ("B2", "pickup", 0)
+    assert index.lookup("99999", 45.0, 9.0) == {}
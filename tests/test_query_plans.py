@@ -0,0 +1,46 @@
+from fixtures.bulk_mock_data_generator import BulkMockDataGenerator
+from db_interface import DbInterface
+from db_interface.index_advisor import CommandRecorder, capture_queries, explain_queries, _get_winning_stages, \
+    _has_blocking_sort
+import pymongo
+import sys
+import os
+sys.path.append(os.getcwd())
+
+
+def test_query_plans(mongo_db):
+    # the commands are recorded by a client connected to the same database
+    recorder = CommandRecorder()
+    client = pymongo.MongoClient(**mongo_db.pmr_credentials.as_mongo_kwargs(), event_listeners=[recorder])
+    db = DbInterface(db_connection=client[mongo_db.name], db_connection_misc=client[mongo_db.name], is_mock=True)
+    db.configure_indexes()
+    generator = BulkMockDataGenerator(seed=0, markets=("crai", "lidl"), stores_per_market=5,
+                                      products_per_market=50, scrape_days=2)
+    # the distances of get_available_markets are computed from numeric coordinates
+    for geo_point in generator.pool_geo_points:
+        geo_point.lat, geo_point.long = float(geo_point.lat), float(geo_point.long)
+    generator.load_to_db(db)
+
+    store = generator.stores()["crai"][0]
+    product_ids = [p._id for p in generator.products()["crai"][:5]]
+    specs = capture_queries(db, recorder, "crai", store._id, product_ids, generator.postal_codes()[0])
+    assert {"get_prices", "get_price_history", "get_available_markets"} <= {s.name for s in specs}
+
+    reports = explain_queries(db, specs)
+    assert all(r.ok for r in reports), "\n".join(str(r) for r in reports if not r.ok)
+    client.close()
+
+
+def test_blocking_sort():
+    # the groups sorted by their `_id` after an index scan
+    explain = {"stages": [
+        {"$cursor": {"queryPlanner": {"winningPlan": {"stage": "FETCH", "inputStage": {"stage": "IXSCAN"}},
+                                      "rejectedPlans": [{"stage": "SORT", "inputStage": {"stage": "COLLSCAN"}}]}}},
+        {"$group": {"_id": "$timeseries_meta.product_id"}},
+        {"$sort": {"sortKey": {"_id": 1}}}]}
+    stages = _get_winning_stages(explain)
+    assert stages == ["IXSCAN", "FETCH", "$group", "$sort"]
+    assert not _has_blocking_sort(stages)
+
+    explain = {"queryPlanner": {"winningPlan": {"stage": "SORT", "inputStage": {"stage": "COLLSCAN"}}}}
+    assert _has_blocking_sort(_get_winning_stages(explain))